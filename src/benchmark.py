@@ -0,0 +1,338 @@
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+import pandas as pd
+import numpy as np
+from typing import Any, Callable, Dict, List, NewType, Tuple
+
+DataFrame = NewType('DataFrame', pd.DataFrame)
+
+'''
+Benchmarks of the pipeline stages on synthetic Superstore shaped
+input. Each benchmark runs in its own process on inputs prepared
+beforehand, so that its peak memory is its own; the best of a few
+timed repeats is kept. Results are compared against a stored
+baseline and the run fails if any benchmark got slower, or used
+more memory, by more than the threshold.
+
+    python src/benchmark.py --sizes 50000 500000 --save-baseline
+    python src/benchmark.py --sizes 50000 500000
+
+--startup instead checks that the command line starts within its
+budget, from the import times python -X importtime reports.
+'''
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_SIZES = [50000, 500000, 5000000]
+DEFAULT_BASELINE = os.path.join(ROOT, 'src', 'benchmark_baseline.json')
+BENCHMARKS = [
+    'transform',
+    'bootstrap.interpolate',
+    'select_columns',
+    'normalize_orders',
+    'normalize_products',
+    'normalize_regions',
+    'normalize_returns',
+    'normalize_customers'
+]
+# differences below these are noise rather than regressions
+NOISE_SECS = 0.05
+NOISE_MB = 16
+# import time allowed for invocations which do no work, and the
+# modules they must not import
+STARTUP_BUDGET_SECS = 0.25
+STARTUP_COMMANDS = [['--help'], ['--show-config']]
+HEAVY_MODULES = {'pandas', 'numpy', 'scipy', 'pyarrow', 'psycopg2'}
+
+
+def synthesize(n: int, seed: int = 0) -> DataFrame:
+    '''
+    Source rows shaped like the Superstore workbook after column
+    normalization. Regions, products and customers are drawn from
+    the reference tables in src/data, those the configs cover,
+    order figures from the reference orders, and dates from the
+    four source years
+    '''
+    rng = np.random.default_rng(seed)
+    data = os.path.join(ROOT, 'src', 'data')
+    with open(os.path.join(ROOT, 'src', 'config', 'bootstrap.json')) as f:
+        ship_delay = json.loads(f.read())['ship_delay']
+    with open(os.path.join(ROOT, 'src', 'config', 'discounts.json')) as f:
+        discounted = json.loads(f.read())['region']
+    regions = pd.read_csv(os.path.join(data, 'regions.csv'))
+    products = pd.read_csv(os.path.join(data, 'products.csv'))
+    customers = pd.read_csv(os.path.join(data, 'customers.csv'))
+    orders = pd.read_csv(os.path.join(data, 'orders.csv'))
+    # only products whose sub category has a configured ship delay
+    products = products[[s in ship_delay.get(c, {}) for c, s in
+                         zip(products['category'], products['sub_category'])]]
+    # and regions with a configured discount
+    regions = regions[regions['region'].isin(list(discounted))]
+
+    r = regions.iloc[rng.integers(0, regions.shape[0], n)].reset_index(drop=True)
+    p = products.iloc[rng.integers(0, products.shape[0], n)].reset_index(drop=True)
+    c = customers.iloc[rng.integers(0, customers.shape[0], n)].reset_index(drop=True)
+    o = orders.iloc[rng.integers(0, orders.shape[0], n)].reset_index(drop=True)
+
+    od = pd.Timestamp('2011-01-01') + pd.to_timedelta(rng.integers(0, 4*365, n), unit='D')
+    sd = od + pd.to_timedelta(rng.integers(0, 8, n), unit='D')
+    # ids spaced out so that bootstrapping to twice the rows has room
+    uids = pd.Series(rng.permutation(4*n)[:n] + 100000).astype(str)
+    return pd.DataFrame({
+        'row_id': np.arange(1, n + 1),
+        'order_id': 'SS-' + pd.Series(od.year).astype(str) + '-' + uids,
+        'order_date': od.strftime('%Y-%m-%d'),
+        'ship_date': sd.strftime('%Y-%m-%d'),
+        'ship_mode': o['ship_mode'],
+        'customer_id': c['customer_id'],
+        'customer_name': c['customer_name'],
+        'segment': c['segment'],
+        'city': r['city'],
+        'state': r['state'],
+        'country': r['country'],
+        'postal_code': pd.to_numeric(r['postal_code'], errors='coerce'),
+        'market': r['region'],
+        'region': r['region'],
+        'product_id': p['product_id'],
+        'category': p['category'],
+        'sub_category': p['sub_category'],
+        'product_name': p['product_name'],
+        'sales': o['sales'],
+        'quantity': o['quantity'],
+        'discount': o['discount'],
+        'profit': o['profit'],
+        'shipping_cost': (o['sales'] * 0.1).round(2),
+        'order_priority': rng.choice(['Low', 'Medium', 'High', 'Critical'], n)
+    })
+
+
+def prepare(n: int, workdir: str):
+    '''
+    Writes the synthetic source and its transformed rows, the
+    inputs of every benchmark, to workdir
+    '''
+    import main
+    from util.rng import set_seed
+    set_seed(0)
+    source = main.compact(synthesize(n))
+    source.to_feather(os.path.join(workdir, 'source.feather'))
+    transformed = main.transform(source, main.load_config('transform.json'))
+    transformed.to_feather(os.path.join(workdir, 'transformed.feather'))
+
+
+def setup(name: str, n: int, workdir: str, workers: int) -> Tuple[Callable[[], tuple], Callable[..., Any]]:
+    '''
+    Loads the inputs of a benchmark and returns a function
+    giving the arguments of a run, called before each repeat
+    outside of the timing, and the function running it once on
+    them. Inputs the benchmarked function modifies are copied
+    by the former
+    '''
+    import main
+    from util.helper import get_postal_code as gpc
+    from util.rng import set_seed
+    set_seed(0)
+    if name == 'transform':
+        source = pd.read_feather(os.path.join(workdir, 'source.feather'))
+        conf = main.load_config('transform.json')
+        return tuple, lambda: main.transform(source, conf)
+
+    transformed = pd.read_feather(os.path.join(workdir, 'transformed.feather'))
+    if name == 'bootstrap.interpolate':
+        conf = main.load_config('bootstrap.json')
+        conf.update(desired_output_rows=2*n, workers=workers, shard_format='csv')
+        def run(df):
+            for _ in main.interpolate(df, conf):
+                pass
+        return lambda: (transformed.copy(),), run
+
+    conf_cols = {'cols': {t: pd.read_csv(os.path.join(main.DIR_DATA, f'{t}.csv'), nrows=0)
+                               .columns.tolist() for t in main.TABLES}}
+    enriched = main.enrich(transformed)
+    if name == 'select_columns':
+        return tuple, lambda: main.select_columns(enriched, conf_cols)
+    dfs = main.select_columns(enriched, conf_cols)
+    if name == 'normalize_orders':
+        _, cjk = main.normalize_regions(dfs['regions'], gpc)
+        return lambda: (dfs['orders'].copy(),), lambda orders: main.normalize_orders(orders, cjk)
+    if name == 'normalize_regions':
+        return tuple, lambda: main.normalize_regions(dfs['regions'], gpc)
+    table = name.split('_', 1)[1]
+    return tuple, lambda: getattr(main, name)(dfs[table])
+
+
+def run_benchmark(name: str, n: int, workdir: str, workers: int, repeat: int) -> Dict[str, Any]:
+    '''
+    Runs a benchmark repeat times in this process
+    '''
+    from util.metrics import peak_rss
+    inputs, fn = setup(name, n, workdir, workers)
+    peak = peak_rss()
+    times = []
+    for _ in range(repeat):
+        args = inputs()
+        start = time.perf_counter()
+        fn(*args)
+        times.append(time.perf_counter() - start)
+    return {
+        'best_secs': min(times),
+        'times': times,
+        'rows_per_sec': n / min(times),
+        'peak_rss_delta_mb': peak_rss() - peak
+    }
+
+
+def run_all(sizes: List[int], benchmarks: List[str], workers: int, repeat: int) -> Dict[str, Any]:
+    results: Dict[str, Dict[str, Any]] = {}
+    workdir = tempfile.mkdtemp(prefix='superstore-bench-')
+    try:
+        # the pipeline reads src/config and src/data and writes to src/out
+        # under SUPERSTORE_ROOT, so it runs in a scratch tree
+        os.makedirs(os.path.join(workdir, 'src', 'out'))
+        for d in ('config', 'data'):
+            os.symlink(os.path.join(ROOT, 'src', d), os.path.join(workdir, 'src', d))
+        for n in sizes:
+            print(f'Preparing {n} rows...', flush=True)
+            child(['--prepare', str(n)], workdir)
+            for name in benchmarks:
+                out = child(['--run', name, str(n), '--workers', str(workers),
+                             '--repeat', str(repeat)], workdir)
+                results.setdefault(name, {})[str(n)] = json.loads(out.splitlines()[-1])
+                r = results[name][str(n)]
+                print(f'{name:<24} {n:>9} rows {r["best_secs"]:>9.3f} s '
+                      f'{r["rows_per_sec"]:>12,.0f} rows/s {r["peak_rss_delta_mb"]:>8.1f} MB', flush=True)
+    finally:
+        shutil.rmtree(workdir)
+    return results
+
+
+def child(args: List[str], workdir: str) -> str:
+    return subprocess.run([sys.executable, os.path.abspath(__file__), *args], cwd=workdir,
+                          env={**os.environ, 'SUPERSTORE_ROOT': workdir},
+                          check=True, stdout=subprocess.PIPE, text=True).stdout
+
+
+def startup(args: List[str]) -> Dict[str, Any]:
+    '''
+    Import time of the command line run with args, and the
+    slowest and the heavy modules it imported
+    '''
+    cli = os.path.join(ROOT, 'src', 'cli.py')
+    err = subprocess.run([sys.executable, '-X', 'importtime', cli, *args], check=True,
+                         stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True).stderr
+    # lines of 'import time: self [us] | cumulative | name', where the
+    # name is indented by its nesting; top level imports add up to the total
+    imports = []
+    for line in err.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        imports.append((name[1:], int(cumulative) / 1e6))
+    top = [(n, t) for n, t in imports if not n.startswith(' ')]
+    return {
+        'import_secs': sum(t for _, t in top),
+        'slowest': sorted(top, key=lambda i: -i[1])[:5],
+        'heavy': sorted({n.strip().split('.')[0] for n, _ in imports} & HEAVY_MODULES)
+    }
+
+
+def check_startup(budget: float) -> List[str]:
+    '''
+    Invocations importing more than budget seconds' worth of
+    modules, or any of the heavy ones
+    '''
+    failures = []
+    for args in STARTUP_COMMANDS:
+        r = startup(args)
+        command = ' '.join(['cli.py', *args])
+        print(f'{command:<24} {r["import_secs"]:>7.3f} s  slowest: ' +
+              ', '.join(f'{n} {t:.3f} s' for n, t in r['slowest']))
+        if r['import_secs'] > budget:
+            failures.append(f'{command} spent {r["import_secs"]:.3f} s importing, '
+                            f'budget {budget:.3f} s')
+        if r['heavy']:
+            failures.append(f'{command} imported {", ".join(r["heavy"])}')
+    return failures
+
+
+def compare(results: Dict[str, Any], baseline: Dict[str, Any], threshold: float) -> List[str]:
+    '''
+    Benchmarks slower, or using more memory, than the baseline
+    by more than threshold (a fraction)
+    '''
+    regressions = []
+    for name, sizes in results.items():
+        for n, r in sizes.items():
+            b = baseline.get(name, {}).get(n)
+            if b is None:
+                continue
+            if r['best_secs'] > max(b['best_secs'] * (1 + threshold), b['best_secs'] + NOISE_SECS):
+                regressions.append(f'{name} at {n} rows took {r["best_secs"]:.3f} s, '
+                                   f'baseline {b["best_secs"]:.3f} s')
+            if r['peak_rss_delta_mb'] > max(b['peak_rss_delta_mb'] * (1 + threshold),
+                                            b['peak_rss_delta_mb'] + NOISE_MB):
+                regressions.append(f'{name} at {n} rows grew peak memory by '
+                                   f'{r["peak_rss_delta_mb"]:.1f} MB, baseline '
+                                   f'{b["peak_rss_delta_mb"]:.1f} MB')
+    return regressions
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Superstore pipeline benchmarks')
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES,
+                        help='source rows to benchmark at')
+    parser.add_argument('--benchmarks', nargs='+', default=BENCHMARKS, choices=BENCHMARKS,
+                        help='benchmarks to run')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='bootstrap worker processes')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='timed runs per benchmark, the best is kept')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE,
+                        help='baseline results to compare against')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='allowed slowdown or memory growth over the baseline, as a fraction')
+    parser.add_argument('--save-baseline', action='store_true',
+                        help='store the results as the new baseline instead of comparing')
+    parser.add_argument('--output', help='also write the results to this file')
+    parser.add_argument('--startup', action='store_true',
+                        help='check the command line startup time instead')
+    parser.add_argument('--startup-budget', type=float, default=STARTUP_BUDGET_SECS,
+                        help='import time allowed at startup, in seconds')
+    # internal; each benchmark runs in a process of its own
+    parser.add_argument('--prepare', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--run', nargs=2, metavar=('BENCHMARK', 'ROWS'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.startup:
+        failures = check_startup(args.startup_budget)
+        for f in failures:
+            print(f'OVER BUDGET {f}')
+        sys.exit(1 if failures else 0)
+    if args.prepare:
+        prepare(args.prepare, os.getcwd())
+        sys.exit(0)
+    if args.run:
+        result = run_benchmark(args.run[0], int(args.run[1]), os.getcwd(), args.workers, args.repeat)
+        print(json.dumps(result))
+        sys.exit(0)
+
+    results = run_all(args.sizes, args.benchmarks, args.workers, args.repeat)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(json.dumps(results, indent=2))
+    if args.save_baseline or not os.path.exists(args.baseline):
+        with open(args.baseline, 'w') as f:
+            f.write(json.dumps(results, indent=2))
+        print(f'Saved baseline to {args.baseline}')
+        sys.exit(0)
+    with open(args.baseline) as f:
+        regressions = compare(results, json.loads(f.read()), args.threshold)
+    for r in regressions:
+        print(f'REGRESSION {r}')
+    sys.exit(1 if regressions else 0)
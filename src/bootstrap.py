@@ -1,51 +1,75 @@
-import re
 import os
+import json
 import shutil
+import itertools
 import sys
 import logging
 import pandas as pd
 import numpy as np
+from concurrent.futures import ProcessPoolExecutor
 from pprint import pprint
-from util.helper import timer
+from util.helper import timer, imap_bounded
+from util import metrics
+from util.uid import UidAllocator
+from util.rng import master_seed, sequence, stream
+from util.writer import TableWriter, table_path
 from transform import get_return_date
-from typing import Dict, NewType, Any
+from typing import Dict, Iterator, NewType, Tuple, Any
 from config.config import DIR_DATA, DIR_CONFIG, DIR_OUTPUT
 
 DataFrame = NewType('DataFrame', pd.DataFrame)
 Series = NewType('Series', pd.Series)
 
 
-def interpolate(df: DataFrame, conf: Dict[Any, Any]) -> DataFrame:
+# settings which may change between a run and its continuation
+APPEND_SETTINGS = {'desired_output_rows', 'workers'}
+
+
+@timer
+def interpolate(df: DataFrame, conf: Dict[Any, Any], append: bool = False) -> Iterator[DataFrame]:
     '''
     Interpolates data to user specified number of rows
-    as dictated by input config dictionary
+    as dictated by input config dictionary. Returns an
+    iterator over the source rows and each generated
+    shard; shards are generated as it is consumed.
+
+    With append, the existing compiled output is extended
+    to desired_output_rows instead of being regenerated and
+    only the new shards are returned
     '''
     logging.debug(f'Interpolating data in {sys._getframe(  ).f_code.co_name}...')
 
     # set an index for proportional sampling
     df['date_rank'] = pd.to_datetime(df['order_date'])
     df.sort_values('date_rank', inplace=True)
-    df['index_rank'] = df.reset_index().index
-
-    # generate a set of order ids to enforce generated PK uniqueness
-    uids = set()
-    def compile_uids(x):
-        n = int(x[x.rfind('-')+1:])
-        uids.add(n)
-        return n
-    order_uids = df['order_id'].apply(compile_uids)
+    df['index_rank'] = np.arange(df.shape[0], dtype='int32')
+
+    # allocate order ids which do not collide with the source to enforce
+    # generated PK uniqueness
+    order_uids = df['order_id'].str.rsplit('-', n=1).str[1].astype('int64')
     max_uid = order_uids.max() + 1
     min_uid = order_uids.min()
-    diff_uid = max_uid - min_uid
+    seed = master_seed(conf.get('seed'))
+    allocator = UidAllocator(min_uid, max_uid, order_uids, key=seed)
     logging.debug(f'UID min: {min_uid}, max: {max_uid}, diff: '
-                  f'{diff_uid - df.shape[0]} {sys._getframe(  ).f_code.co_name}...')
-    if diff_uid <= (conf['desired_output_rows'] - df.shape[0]):
+                  f'{allocator.size} {sys._getframe(  ).f_code.co_name}...')
+    if allocator.size < (conf['desired_output_rows'] - df.shape[0]):
         raise Exception(f'Unable to produce {conf["desired_output_rows"]}'
                         f' with available number of UIDs')
     del order_uids
 
+    # rows and shards generated by previous runs
+    done, done_shards = 0, 0
+    if append:
+        done, done_shards = read_compiled(df, conf, allocator)
+        if done > conf['desired_output_rows'] - df.shape[0]:
+            raise Exception(f'{df.shape[0] + done} rows already generated, more than the '
+                            f'{conf["desired_output_rows"]} desired; run without appending')
+        logging.debug(f'Appending {conf["desired_output_rows"] - df.shape[0] - done} rows '
+                      f'to {df.shape[0] + done} existing rows')
+
     # clean up any previously existing output files
-    for file_name in os.listdir(DIR_OUTPUT):
+    for file_name in os.listdir(DIR_OUTPUT) if not append else []:
         file_path = os.path.join(DIR_OUTPUT, file_name)
         try:
             if os.path.isfile(file_path) or os.path.islink(file_path):
@@ -56,74 +80,93 @@ def interpolate(df: DataFrame, conf: Dict[Any, Any]) -> DataFrame:
             logging.error(f'Failed to delete {file_path}. Reason: {e}')
 
     # generate rows in shard_size increments
-    out_dict = {}
-    for i in range(conf['desired_output_rows'] - df.shape[0]):
-        n = i + df.shape[0]
-        samp = df.sample(1, weights=df['index_rank'])
-        out_dict[n] = generate_row(
-            samp,
-            conf,
-            min_uid,
-            max_uid,
-            uids).iloc[0,:].to_dict()
+    if conf.get('engine', 'row') == 'batch':
+        # draw each shard as whole arrays rather than row by row
+        shards = generate_shards(df, conf, allocator, seed, done, done_shards)
+    else:
+        shards = generate_row_shards(df, conf, allocator, seed, done)
 
-        if n%conf['shard_size'] == 0:
-            logging.debug(f'Bootstrapping record number {n}')
-            pd.DataFrame.from_dict(out_dict, orient='index').to_csv(
-                os.path.join(DIR_OUTPUT, f'bootshard_{n - conf["shard_size"]}.csv'),
-                index_label='id',
-                header=False)
-            out_dict = {}
+    return compile_shards(df, shards, conf, append, done_shards)
+
+
+def compile_shards(df: DataFrame, shards: Iterator[DataFrame], conf: Dict[Any, Any],
+                   append: bool = False, done_shards: int = 0) -> Iterator[DataFrame]:
+    '''
+    Streams the source rows followed by each generated shard
+    into the compiled output as they are produced, yielding
+    each one on to the downstream stages. When appending, only
+    the new shards are written and yielded. The settings used
+    are recorded alongside once every shard is written
+    '''
+    fmt = conf.get('shard_format', 'csv')
+    path = table_path(DIR_OUTPUT, 'bootshard_compiled', fmt)
+    chunks = shards if append else itertools.chain([df], shards)
+    n = 0
+    with TableWriter(path, fmt, mode='a' if append else 'w', index_label='id') as writer:
+        for shard in chunks:
+            writer.write(shard)
+            n += shard.shape[0]
+            done_shards += shard is not df
+            yield shard
+    with open(compiled_meta_path(conf), 'w') as f:
+        f.write(json.dumps({
+            'source_rows': df.shape[0],
+            'shards': done_shards,
+            'conf': {k: v for k, v in conf.items() if k not in APPEND_SETTINGS}
+        }, indent=2))
+    logging.debug(f'Processed {n} records in {sys._getframe(  ).f_code.co_name}...')
+
+
+@timer
+def read_compiled(df: DataFrame, conf: Dict[Any, Any], allocator: UidAllocator) -> Tuple[int, int]:
+    '''
+    Checks that the existing compiled output continues from
+    the same source rows and settings, and returns the number
+    of rows and shards generated so far
+    '''
+    fmt = conf.get('shard_format', 'csv')
+    path = table_path(DIR_OUTPUT, 'bootshard_compiled', fmt)
+    if not os.path.exists(path) or not os.path.exists(compiled_meta_path(conf)):
+        raise Exception(f'No compiled output at {path} to append to')
+    with open(compiled_meta_path(conf)) as f:
+        meta = json.loads(f.read())
+    changed = sorted(k for k in set(meta['conf']) | set(conf)
+                     if k not in APPEND_SETTINGS and meta['conf'].get(k) != conf.get(k))
+    if changed or meta['source_rows'] != df.shape[0]:
+        raise Exception(f'Compiled output was generated with different source rows or '
+                        f'settings {changed}; run without appending')
+
+    if fmt == 'csv':
+        order_ids = pd.read_csv(path, usecols=['order_id'])['order_id']
+    else:
+        order_ids = pd.read_parquet(path, columns=['order_id'])['order_id']
+    # generated rows hold the order ids at allocator positions 0, 1, ...
+    # so ids after them can only be new if these match
+    done = order_ids.shape[0] - df.shape[0]
+    uids = order_ids.iloc[df.shape[0]:].str.rsplit('-', n=1).str[1].astype('int64').values
+    if done < 0 or not np.array_equal(uids, allocator.at(np.arange(done))):
+        raise Exception(f'Order ids in {path} do not follow from seed {conf.get("seed")}; '
+                        f'run without appending')
+    return done, meta['shards']
 
-    # write remaining rows to file
-    pd.DataFrame.from_dict(out_dict, orient='index').to_csv(
-        os.path.join(DIR_OUTPUT, f'bootshard_{n - conf["shard_size"]}.csv'),
-        index_label='id',
-        header=False)
-    del out_dict
-
-    # recombine shards
-    shards = []
-    for f in os.listdir(DIR_OUTPUT):
-        if re.search(r'^bootshard_\d+.csv$', f):
-            shards.append(f)
-
-    df.to_csv(
-        os.path.join(DIR_OUTPUT, 'bootshard_compiled.csv'),
-        index_label='id',
-        header=True,
-        mode='w')
-
-    for s in shards:
-        df_s = pd.read_csv(
-            os.path.join(DIR_OUTPUT, s),
-            index_col=0,
-            header=None
-        )
-        df_s.to_csv(
-            os.path.join(DIR_OUTPUT, 'bootshard_compiled.csv'),
-            index_label='id',
-            header=False,
-            mode='a')
-        logging.debug(f'Completed compiling shard num: {s}')
-
-    logging.debug(f'Processed {df.shape[0] + conf["desired_output_rows"]} records in {sys._getframe(  ).f_code.co_name}...')
-    compiled_df = pd.read_csv(os.path.join(DIR_OUTPUT, 'bootshard_compiled.csv'), index_col='id')
-    return compiled_df
+
+def compiled_meta_path(conf: Dict[Any, Any]) -> str:
+    fmt = conf.get('shard_format', 'csv')
+    return table_path(DIR_OUTPUT, 'bootshard_compiled', fmt) + '.json'
 
 
 ##################
 # Helper Functions
 ##################
 
-def generate_row(df, conf, min_uid, max_uid, uids):
+def generate_row(df, conf, allocator, rng):
     # single row df
     samp = df
 
-    od = generate_order_or_ship_date(samp['order_date'].values[0], conf['order_date_low'], conf['order_date_high'])
-    oid = generate_order_id(samp['order_id'].values[0], od.year, min_uid, max_uid, uids)
+    od = generate_order_or_ship_date(samp['order_date'].values[0], conf['order_date_low'], conf['order_date_high'], rng)
+    oid = generate_order_id(samp['order_id'].values[0], od.year, allocator)
     ship_low, ship_high, ship_mode = conf['ship_delay'][samp['category'].values[0]][samp['sub_category'].values[0]]
-    sd = generate_order_or_ship_date(od, ship_low, ship_high)
+    sd = generate_order_or_ship_date(od, ship_low, ship_high, rng)
     dis, prof = generate_discount_and_profit(samp['discount'].values[0], od.year, conf).values()
 
     res = samp.copy()
@@ -133,41 +176,188 @@ def generate_row(df, conf, min_uid, max_uid, uids):
     res['ship_date'] = sd
     res['discount'] = dis
     res['profit'] = prof
-    res['return_date'] = get_return_date(pd.DataFrame({'ship_date': [sd], 'order_date': [od]}), conf).values[0]
+    # undecorated, as timing and logging every row would cost more
+    # than the row; batches of rows are timed where they are drawn
+    res['return_date'] = get_return_date.__wrapped__(
+        pd.DataFrame({'ship_date': [sd], 'order_date': [od]}), conf, rng).values[0]
 
     return res
 
-def get_random_id(min_id, max_id, dtype='int'):
-    return np.random.randint(min_id, max_id, dtype=dtype)
+def generate_row_shards(df, conf, allocator, seed, done=0):
+    '''
+    Generates shards one sampled row at a time, after the
+    done rows generated previously. The stream is keyed on
+    done, so appended rows are not a replay of the first ones
+    '''
+    allocator.counter = done
+    rng = stream('bootstrap.row', done, seed=seed)
+    out_dict = {}
+    for i in range(done, conf['desired_output_rows'] - df.shape[0]):
+        n = i + df.shape[0]
+        samp = df.sample(1, weights=df['index_rank'], random_state=rng)
+        out_dict[n] = generate_row(
+            samp,
+            conf,
+            allocator,
+            rng).iloc[0,:].to_dict()
+
+        if len(out_dict) == conf['shard_size']:
+            logging.debug(f'Bootstrapping record number {n}')
+            yield pd.DataFrame.from_dict(out_dict, orient='index')
+            out_dict = {}
+
+    # remaining rows
+    if out_dict:
+        yield pd.DataFrame.from_dict(out_dict, orient='index')
+
+def generate_shards(df, conf, allocator, seed, done=0, done_shards=0):
+    '''
+    Generates shard_size row shards across a pool of worker
+    processes and yields them in order. Each shard draws from its
+    own stream of the master seed and allocates the order ids at its
+    own row positions, so the output is the same for any number of
+    workers. At most two shards per worker are in flight at once.
+
+    Generation continues after the done rows and done_shards
+    shards of a previous run; continuing a run whose rows filled
+    whole shards gives the same rows as one longer run
+    '''
+    n_new = conf['desired_output_rows'] - df.shape[0]
+    starts = list(range(done, n_new, conf['shard_size']))
+    if not starts:
+        return
+    logging.debug(f'Bootstrapping {len(starts)} shards with master seed {seed}')
+    # the i-th shard draws from the i-th shard stream of bootstrap
+    tasks = [(df.shape[0] + start,
+              min(conf['shard_size'], n_new - start),
+              start,
+              sequence('bootstrap', done_shards + i, seed=seed))
+             for i, start in enumerate(starts)]
+
+    workers = conf.get('workers') or os.cpu_count()
+    if workers == 1:
+        init_shard_worker(df, conf, allocator)
+        yield from map(generate_shard, tasks)
+        return
+    with ProcessPoolExecutor(max_workers=workers,
+                             initializer=init_shard_process,
+                             initargs=(df, conf, allocator)) as executor:
+        for shard, shard_metrics in imap_bounded(executor, generate_shard_in_worker, tasks, 2*workers):
+            metrics.merge(shard_metrics)
+            yield shard
+
+# per-process state shared by every shard a worker generates
+_shard_state: Dict[str, Any] = {}
+
+def init_shard_worker(df, conf, allocator):
+    _shard_state['df'] = df
+    _shard_state['conf'] = conf
+    _shard_state['allocator'] = allocator
+
+def init_shard_process(df, conf, allocator):
+    # forked workers start with a copy of the parent's metrics,
+    # which would be counted twice once merged back
+    metrics.drain()
+    init_shard_worker(df, conf, allocator)
+
+def generate_shard(task):
+    '''
+    Generates a single shard; task is a tuple of (offset,
+    rows, first allocator position, seed sequence). Each
+    shard's timings are kept in the run metrics
+    '''
+    offset, n, uid_start, seed = task
+    logging.debug(f'Bootstrapping record number {offset}')
+    with metrics.measure('bootstrap.generate_shard', offset=offset) as m:
+        shard = generate_rows(
+            _shard_state['df'],
+            n,
+            _shard_state['conf'],
+            _shard_state['allocator'].at(np.arange(uid_start, uid_start + n)),
+            offset=offset,
+            rng=np.random.default_rng(seed))
+        m['rows'] = n
+    return shard
+
+def generate_shard_in_worker(task):
+    '''
+    generate_shard for pool workers, which hand the metrics
+    they gathered back along with the shard
+    '''
+    return generate_shard(task), metrics.drain()
 
-def get_uid(min_id, max_id, uids):
+def generate_rows(df, n, conf, uids, offset=0, rng=None):
+    '''
+    Batched counterpart of generate_row; draws n weighted
+    samples at once and builds every generated column as
+    a whole array, indexed from offset. uids holds the n
+    order id numbers to assign
+    '''
+    rng = rng or stream('bootstrap')
+    samp = df.sample(n, replace=True, weights=df['index_rank'], random_state=rng)
+    samp.index = pd.RangeIndex(offset, offset + n)
+
+    od = pd.to_datetime(samp['order_date']) + pd.to_timedelta(
+        rng.integers(conf['order_date_low'], conf['order_date_high']+1, size=n), unit='D')
+    years = od.dt.year
+    oid = samp['order_id'].str.split('-').str[0] + '-' + years.astype(str) + '-' +\
+        pd.Series(uids, index=samp.index).astype(str)
+
+    # ship delay bounds and mode per (category, sub_category)
+    delays = pd.DataFrame(
+        [[c, s, *v] for c, sc in conf['ship_delay'].items() for s, v in sc.items()],
+        columns=['category', 'sub_category', 'ship_low', 'ship_high', 'ship_mode'])
+    sdl = samp[['category', 'sub_category']].merge(
+        delays, how='left', on=['category', 'sub_category'])
+    sd = od + pd.to_timedelta(
+        rng.integers(sdl['ship_low'].values, sdl['ship_high'].values+1), unit='D')
+
+    amt = years.astype(str).map(conf['discounts'])
+    if amt.isnull().any():
+        raise KeyError(f'No discount configured for years '
+                       f'{sorted(years[amt.isnull()].unique())}')
+
+    # samp is already a new frame, so columns are replaced in it
+    # directly; every shard shares the source's categories
+    discount = samp['discount']
+    samp['order_date'] = od
+    samp['order_id'] = oid
+    samp['ship_mode'] = pd.Categorical(sdl['ship_mode'].values, dtype=ship_mode_dtype(df, conf))
+    samp['ship_date'] = sd
+    samp['discount'] = discount + amt
+    samp['profit'] = discount - (discount*amt)
+    samp['return_date'] = get_return_date(
+        pd.DataFrame({'ship_date': sd, 'order_date': od}), conf, rng).values
+
+    return samp
+
+def ship_mode_dtype(df, conf):
+    '''
+    Categories of the source ship modes and those configured
+    '''
+    modes = {v[2] for sc in conf['ship_delay'].values() for v in sc.values()}
+    return pd.CategoricalDtype(df['ship_mode'].cat.categories.union(sorted(modes)))
+
+def get_uid(allocator):
     '''
     Fetches UID that does not conflict with existing
-    dataset UIDs
-    '''
-    rid = get_random_id(min_id, max_id)
-    i = 0
-    while rid in uids:
-        if i > 100000:
-            if i%100000 == 0:
-                logging.warn(f'{sys._getframe(  ).f_code.co_name} is hanging with i: {i}, min_id: {min_id}, max_id: {max_id}, rid: {rid}...')
-        rid = get_random_id(min_id, max_id)
-        i += 1
-    return rid
-
-def generate_order_or_ship_date(x, date_low, date_high):
+    dataset UIDs or previously fetched UIDs
+    '''
+    return allocator.take(1)[0]
+
+def generate_order_or_ship_date(x, date_low, date_high, rng):
     if isinstance(x, pd.Timestamp):
         x = x.to_datetime64()
-    return x + pd.Timedelta(np.random.randint(low=date_low, high=date_high+1, size=1)[0], unit='D')
+    return x + pd.Timedelta(rng.integers(low=date_low, high=date_high+1), unit='D')
 
-def generate_order_id(x, target_year, min_uid, max_uid, uids):
+def generate_order_id(x, target_year, allocator):
     prefix, _, uid = x.split('-')
     return '-'.join(
-        [prefix, str(target_year), str(get_uid(min_uid, max_uid, uids))])
+        [prefix, str(target_year), str(get_uid(allocator))])
 
 # TODO
-def generate_ship_mode(vals, dist):
-    return np.random.choice(vals, p=dist)
+def generate_ship_mode(vals, dist, rng):
+    return rng.choice(vals, p=dist)
 
 def generate_discount_and_profit(x, year, discount_dict):
     amt = discount_dict['discounts'][str(year)]
@@ -0,0 +1,159 @@
+import os
+import re
+import sys
+import json
+import argparse
+import logging
+from typing import Any, Dict, List, Tuple
+from config.config import DIR_CONFIG, ROOT
+
+'''
+Command line entry point. Parsing arguments and reading the
+configs only needs the standard library, so --help, --show-config
+and bad arguments return at once; the pipeline and its heavy
+dependencies are imported once there is work to do.
+
+    python src/cli.py all --rows 200000 --workers 4
+    python src/cli.py bootstrap --seed 7 --dry-run
+    python src/cli.py normalize --set bootstrap.order_date_low=-10
+'''
+
+COMMANDS: Dict[str, str] = {
+    'transform': 'transform the source workbook',
+    'bootstrap': 'transform, then bootstrap to desired_output_rows',
+    'normalize': 'everything up to the normalized tables',
+    'all': 'every enabled stage, validation, the integrity check, the database load and the export included'
+}
+# config files which may be overridden, and the options overriding their keys
+CONFIGS = ['bootstrap.json', 'transform.json', 'engine.json']
+# keys which may be set without being in the config already
+NEW_KEYS: Dict[str, str] = {'transform.json': r'y\d+_mapping'}
+OPTIONS: Dict[str, Tuple[str, str]] = {
+    'rows': ('bootstrap.json', 'desired_output_rows'),
+    'shard_size': ('bootstrap.json', 'shard_size'),
+    'seed': ('bootstrap.json', 'seed'),
+    'workers': ('bootstrap.json', 'workers'),
+    'engine': ('engine.json', 'name')
+}
+
+
+def parse(argv: List[str] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description='Superstore transformation pipeline',
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog='commands:\n' + '\n'.join(f'  {k:<12} {v}' for k, v in COMMANDS.items()))
+    parser.add_argument('command', nargs='?', default='all', choices=list(COMMANDS),
+                        help='stages to run, with the stages they depend on (default: all)')
+    parser.add_argument('--rows', type=int,
+                        help='desired_output_rows of bootstrap.json')
+    parser.add_argument('--shard-size', type=int,
+                        help='shard_size of bootstrap.json')
+    parser.add_argument('--seed', type=int,
+                        help='master seed of every random draw, seed of bootstrap.json')
+    parser.add_argument('--workers', type=int,
+                        help='bootstrap worker processes, workers of bootstrap.json')
+    parser.add_argument('--engine', choices=['pandas', 'polars'],
+                        help='dataframe engine normalization runs on, name of engine.json')
+    parser.add_argument('--set', action='append', default=[], metavar='FILE.KEY=VALUE',
+                        help='override any key of bootstrap.json, transform.json or engine.json, e.g. '
+                             'bootstrap.order_date_low=-10; values are read as JSON of the type the key '
+                             'holds, or null, unless the key holds text')
+    parser.add_argument('--show-config', action='store_true',
+                        help='print the configs with the overrides applied and exit')
+    parser.add_argument('--refresh-cache', action='store_true',
+                        help='discard cached source data and re-read it')
+    parser.add_argument('--force', nargs='*', metavar='STAGE',
+                        help='re-run the named stages, or every stage if none are named; give the '
+                             'command before --force, as the names following it are taken as stages')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='report which stages would re-run and exit')
+    parser.add_argument('--append', action='store_true',
+                        help='extend the previous output up to desired_output_rows instead of regenerating it')
+    parser.add_argument('--profile', action='store_true',
+                        help='capture a cProfile of the run to src/out/profile.prof')
+    args = parser.parse_args(argv)
+    args.configs = configs = {}
+    for name in CONFIGS:
+        with open(os.path.join(DIR_CONFIG, name)) as f:
+            configs[name] = json.loads(f.read())
+    try:
+        args.overrides = overrides(args, configs)
+    except ValueError as e:
+        parser.error(str(e))
+    return args
+
+
+def overrides(args: argparse.Namespace, configs: Dict[str, Dict[str, Any]]) -> Dict[str, Dict[str, Any]]:
+    '''
+    Config keys overridden by the options, by config file.
+    Values of keys holding text in the config are kept as text;
+    others must be JSON of the type the key holds, or null. An
+    integer may set a float, and a whole float an integer
+    '''
+    out: Dict[str, Dict[str, Any]] = {c: {} for c in CONFIGS}
+    for item in args.set:
+        target, sep, value = item.partition('=')
+        name, _, key = target.partition('.')
+        if not sep or not key or f'{name}.json' not in out:
+            raise ValueError(f'--set {item!r} is not of the form FILE.KEY=VALUE with FILE '
+                             f'one of {", ".join(c[:-len(".json")] for c in CONFIGS)}')
+        config = configs[f'{name}.json']
+        if key not in config and not re.fullmatch(NEW_KEYS.get(f'{name}.json', '$^'), key):
+            raise ValueError(f'--set {item!r}: {name}.json has no key {key!r}')
+        current = config.get(key)
+        if isinstance(current, str) or key not in config:
+            out[f'{name}.json'][key] = value
+            continue
+        try:
+            parsed = json.loads(value)
+        except json.JSONDecodeError:
+            raise ValueError(f'--set {item!r}: {value!r} is not valid JSON')
+        if isinstance(current, int) and not isinstance(current, bool) \
+                and isinstance(parsed, float) and parsed.is_integer():
+            parsed = int(parsed)
+        if not (parsed is None or current is None or same_type(parsed, current)):
+            raise ValueError(f'--set {item!r}: {key} holds {type(current).__name__}, '
+                             f'not {type(parsed).__name__}')
+        out[f'{name}.json'][key] = parsed
+    for option, (name, key) in OPTIONS.items():
+        if getattr(args, option) is not None:
+            out[name][key] = getattr(args, option)
+    return out
+
+
+def same_type(value: Any, current: Any) -> bool:
+    '''
+    Whether value may replace current; an integer may replace
+    a float, but not the other way round, nor a boolean either
+    '''
+    if isinstance(current, float) and isinstance(value, int) and not isinstance(value, bool):
+        return True
+    return type(value) == type(current)
+
+
+def show_config(configs: Dict[str, Dict[str, Any]], overrides: Dict[str, Dict[str, Any]]):
+    for name in CONFIGS:
+        print(f'{name}:\n{json.dumps({**configs[name], **overrides[name]}, indent=2)}')
+
+
+def run(argv: List[str] = None) -> int:
+    args = parse(argv)
+    if args.show_config:
+        show_config(args.configs, args.overrides)
+        return 0
+
+    logging.basicConfig(
+        level=logging.DEBUG,
+        filename=os.path.join(ROOT, 'out.log'),
+        format='%(asctime)s %(message)s',
+        datefmt='%m/%d/%Y %I:%M:%S %p')
+    from main import main
+    main(refresh_cache=args.refresh_cache, force=args.force, dry_run=args.dry_run,
+         append=args.append, profile=args.profile,
+         targets=None if args.command == 'all' else [args.command],
+         overrides=args.overrides)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(run())
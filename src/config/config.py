@@ -1,5 +1,11 @@
 import os
 
-DIR_DATA = os.path.join('src', 'data')
-DIR_CONFIG = os.path.join('src', 'config')
-DIR_OUTPUT = os.path.join('src', 'out')
+# paths resolve against the project root rather than the working
+# directory; SUPERSTORE_ROOT points them at another tree
+ROOT = os.environ.get('SUPERSTORE_ROOT') or \
+    os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+DIR_DATA = os.path.join(ROOT, 'src', 'data')
+DIR_CONFIG = os.path.join(ROOT, 'src', 'config')
+DIR_OUTPUT = os.path.join(ROOT, 'src', 'out')
+DIR_CACHE = os.path.join(ROOT, 'src', 'cache')
+DIR_STAGES = os.path.join(ROOT, 'src', 'stages')
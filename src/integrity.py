@@ -0,0 +1,176 @@
+import logging
+import pandas as pd
+from typing import Any, Dict, Iterator, List, NewType, Tuple
+from config.config import DIR_OUTPUT
+from load import SCHEMA, PRIMARY_KEYS, FOREIGN_KEYS
+from util.helper import timer
+from util.writer import table_path, read_table
+
+DataFrame = NewType('DataFrame', pd.DataFrame)
+Series = NewType('Series', pd.Series)
+
+'''
+Referential integrity of the normalized tables, checked before
+they are loaded anywhere. The keys of each referenced table are
+read once into a hash index, then the referencing tables are
+streamed in chunks of their key columns only and every value is
+looked up at once; primary keys are checked for nulls and
+duplicates the same way. Violations are counted, with a few
+examples of each, into a compact report.
+'''
+
+# (table, column, referenced table, referenced column); the keys
+# declared on load, and returns.order_id which references orders
+# without a key, as an order id is shared by each line item
+REFERENCES: List[Tuple[str, str, str, str]] = \
+    [(t, c, r, PRIMARY_KEYS[r]) for t, c, r in FOREIGN_KEYS] + \
+    [('returns', 'order_id', 'orders', 'order_id')]
+
+
+class KeyIndex:
+    '''
+    Hash index of the distinct non-null values of a key column,
+    built once every chunk of it was added. For a primary key,
+    the nulls and the values seen more than once are counted
+    too; other columns only keep the distinct values of each
+    chunk until then
+    '''
+
+    def __init__(self, examples: int, primary: bool = True):
+        self.primary = primary
+        self.rows = 0
+        self.nulls = 0
+        self.duplicates = 0
+        self.examples: List[Any] = []
+        self._examples = examples
+        self._chunks: List[Series] = []
+        self._index: pd.Index = None
+
+    def update(self, s: Series):
+        self.rows += s.shape[0]
+        values = s.dropna()
+        self.nulls += s.shape[0] - values.shape[0]
+        self._chunks.append(values if self.primary else pd.Series(values.unique()))
+
+    def build(self) -> pd.Index:
+        '''
+        Indexes the values added; duplicates are counted here
+        rather than per chunk as they may span chunks
+        '''
+        if self._index is None:
+            values = pd.concat(self._chunks, ignore_index=True) if self._chunks else pd.Series([])
+            self._chunks = []
+            if self.primary:
+                duplicated = values.duplicated().to_numpy()
+                self.duplicates = int(duplicated.sum())
+                self.examples = pd.unique(values[duplicated])[:self._examples].tolist()
+                self._index = pd.Index(values[~duplicated])
+            else:
+                self._index = pd.Index(pd.unique(values))
+        return self._index
+
+
+class Violations:
+    '''
+    Values of a column missing from the column it references,
+    counted chunk by chunk. Each distinct value of a chunk is
+    looked up once, as foreign keys mostly repeat
+    '''
+
+    def __init__(self, examples: int):
+        self.rows = 0
+        self.nulls = 0
+        self.missing = 0
+        self.examples: List[Any] = []
+        self._examples = examples
+
+    def update(self, s: Series, index: KeyIndex):
+        codes, uniques = pd.factorize(s)
+        absent = index.build().get_indexer(uniques) < 0
+        self.rows += s.shape[0]
+        self.nulls += int((codes < 0).sum())
+        self.missing += int(absent[codes[codes >= 0]].sum())
+        for v in uniques[absent].tolist():
+            if len(self.examples) >= self._examples:
+                break
+            if v not in self.examples:
+                self.examples.append(v)
+
+
+@timer
+def check(conf: Dict[str, Any], conf_out: Dict[str, Any]) -> Dict[str, Any]:
+    '''
+    Checks the primary key of every table and each reference
+    between tables; returns the integrity report
+    '''
+    logging.info(f'Beginning integrity check...')
+    keys = {(t, c): KeyIndex(conf['examples']) for t, c in PRIMARY_KEYS.items()}
+    keys.update({(r, rc): KeyIndex(conf['examples'], primary=False)
+                 for _, _, r, rc in REFERENCES if (r, rc) not in keys})
+    references = {(t, c, r, rc): Violations(conf['examples']) for t, c, r, rc in REFERENCES}
+    rows = {}
+    # referenced tables are indexed before the tables referencing
+    # them are streamed past their indexes
+    order: List[str] = []
+    while len(order) < len(PRIMARY_KEYS):
+        order += [t for t in PRIMARY_KEYS if t not in order
+                  and all(r in order for f, _, r, _ in REFERENCES if f == t)]
+    for table in order:
+        indexed = [c for t, c in keys if t == table]
+        checked = [k for k in references if k[0] == table]
+        rows[table] = 0
+        for df in read_keys(table, indexed + [k[1] for k in checked], conf, conf_out):
+            rows[table] += df.shape[0]
+            for c in indexed:
+                keys[table, c].update(df[c])
+            for k in checked:
+                references[k].update(df[k[1]], keys[k[2], k[3]])
+        for c in indexed:
+            keys[table, c].build()
+    return report(rows, keys, references, conf)
+
+
+def read_keys(table: str, columns: List[str], conf: Dict[str, Any],
+              conf_out: Dict[str, Any]) -> Iterator[DataFrame]:
+    '''
+    Chunks of the distinct columns of a table, integer keys as
+    nullable integers and the others as text. Integers are
+    cast once parsed, as read_csv is slow to parse them as
+    nullable integers
+    '''
+    columns = list(dict.fromkeys(columns))
+    integers = {c: 'Int64' for c in columns if SCHEMA[table][c] == 'integer'}
+    fmt = conf_out['format']
+    kwargs = {'dtype': {c: object for c in columns if c not in integers}} if fmt == 'csv' else {}
+    for df in read_table(table_path(DIR_OUTPUT, table, fmt), fmt, conf['batch_rows'], columns, **kwargs):
+        # parquet tables restore their index
+        if df.index.name is not None:
+            df = df.reset_index()
+        yield df.astype(integers)
+
+
+def report(rows: Dict[str, int], keys: Dict[Tuple[str, str], KeyIndex],
+           references: Dict[Tuple[str, str, str, str], Violations], conf: Dict[str, Any]) -> Dict[str, Any]:
+    primary_keys = {f'{t}.{c}': {'rows': keys[t, c].rows,
+                                 'nulls': keys[t, c].nulls,
+                                 'duplicates': keys[t, c].duplicates,
+                                 'examples': keys[t, c].examples}
+                    for t, c in PRIMARY_KEYS.items()}
+    foreign_keys = {f'{t}.{c} -> {r}.{rc}': {'rows': v.rows,
+                                             'nulls': v.nulls,
+                                             'missing': v.missing,
+                                             'examples': v.examples}
+                    for (t, c, r, rc), v in references.items()}
+    violations = {k: v['nulls'] + v['duplicates'] for k, v in primary_keys.items()}
+    violations.update({k: v['missing'] + (0 if conf['allow_null_references'] else v['nulls'])
+                       for k, v in foreign_keys.items()})
+    failed = [k for k, v in violations.items() if v]
+    for k in failed:
+        logging.warning(f'{violations[k]} rows violate {k}')
+    return {
+        'passed': not failed,
+        'failed': failed,
+        'rows': rows,
+        'primary_keys': primary_keys,
+        'foreign_keys': foreign_keys
+    }
@@ -0,0 +1,295 @@
+import io
+import os
+import sys
+import sqlite3
+import logging
+import pandas as pd
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, Iterator, List, NewType, Tuple, Any
+from util.writer import table_path, read_table, CSV_NA
+from config.config import DIR_OUTPUT, ROOT
+
+DataFrame = NewType('DataFrame', pd.DataFrame)
+
+'''
+Loads the normalized tables into a database. Tables are created
+bare, streamed in batches (COPY FROM STDIN on postgres, batched
+inserts on the sqlite stand-in) and keyed and indexed once loaded.
+'''
+
+BACKENDS = {'postgres', 'sqlite'}
+
+# columns of every rollup table, after the columns it is grouped by
+ROLLUP_COLUMNS: Dict[str, str] = {
+    'order_lines': 'integer',
+    'returned_lines': 'integer',
+    'sales': 'float',
+    'profit': 'float',
+    'discount_sum': 'float',
+    'discount': 'float',
+    'return_rate': 'float'
+}
+
+# column types of each table
+SCHEMA: Dict[str, Dict[str, str]] = {
+    'regions': {
+        'id': 'integer',
+        'region': 'text',
+        'country': 'text',
+        'state': 'text',
+        'city': 'text',
+        'salesperson': 'text',
+        'postal_code': 'float',
+        'country_code': 'text'
+    },
+    'products': {
+        'product_id': 'text',
+        'category': 'text',
+        'sub_category': 'text',
+        'product_name': 'text',
+        'product_cost_to_consumer': 'float'
+    },
+    'customers': {
+        'customer_id': 'text',
+        'customer_name': 'text',
+        'segment': 'text'
+    },
+    'orders': {
+        'id': 'integer',
+        'order_id': 'text',
+        'order_date': 'date',
+        'ship_date': 'date',
+        'ship_mode': 'text',
+        'customer_id': 'text',
+        'product_id': 'text',
+        'sales': 'float',
+        'quantity': 'integer',
+        'discount': 'float',
+        'profit': 'float',
+        'region_id': 'integer'
+    },
+    'returns': {
+        'order_id': 'text',
+        'return_date': 'date',
+        'return_quantity': 'integer',
+        'reason_returned': 'text'
+    },
+    'sales_by_month_region_sub_category': {
+        'month': 'date',
+        'region': 'text',
+        'sub_category': 'text',
+        **ROLLUP_COLUMNS
+    },
+    'sales_by_segment': {
+        'segment': 'text',
+        **ROLLUP_COLUMNS
+    }
+}
+
+TYPES: Dict[str, Dict[str, str]] = {
+    'postgres': {'integer': 'bigint', 'float': 'double precision', 'text': 'text', 'date': 'date'},
+    'sqlite': {'integer': 'INTEGER', 'float': 'REAL', 'text': 'TEXT', 'date': 'TEXT'}
+}
+
+# keyed tables; rollups are only indexed
+PRIMARY_KEYS = {
+    'regions': 'id',
+    'products': 'product_id',
+    'customers': 'customer_id',
+    'orders': 'id',
+    'returns': 'order_id'
+}
+
+# (table, column, referenced table); references its primary key.
+# returns.order_id is indexed on orders rather than keyed, as an
+# order id is shared by each line item of the order
+FOREIGN_KEYS: List[Tuple[str, str, str]] = [
+    ('orders', 'customer_id', 'customers'),
+    ('orders', 'product_id', 'products'),
+    ('orders', 'region_id', 'regions')
+]
+
+INDEXES: List[Tuple[str, str]] = [
+    ('orders', 'order_id'),
+    ('orders', 'customer_id'),
+    ('orders', 'product_id'),
+    ('orders', 'region_id'),
+    ('orders', 'order_date'),
+    ('sales_by_month_region_sub_category', 'month'),
+    ('sales_by_month_region_sub_category', 'region'),
+    ('sales_by_month_region_sub_category', 'sub_category'),
+    ('sales_by_segment', 'segment')
+]
+
+# tables within a wave are loaded in parallel; each wave only
+# references tables of the waves before it
+LOAD_WAVES = [['regions', 'products', 'customers', 'sales_by_month_region_sub_category', 'sales_by_segment'],
+              ['orders', 'returns']]
+
+
+class Database:
+    '''
+    Connections to the target database. Postgres connections are
+    drawn from a pool of up to workers connections; sqlite opens
+    one per use, as it only allows a single writer at a time
+    '''
+
+    def __init__(self, conf: Dict[Any, Any]):
+        if conf['backend'] not in BACKENDS:
+            raise ValueError(f'Unknown database backend {conf["backend"]!r}, '
+                             f'expected one of {sorted(BACKENDS)}')
+        self.backend = conf['backend']
+        self.workers = conf['workers'] if self.backend == 'postgres' else 1
+        if self.backend == 'postgres':
+            from psycopg2.pool import ThreadedConnectionPool
+            self._pool = ThreadedConnectionPool(1, self.workers, conf['dsn'])
+        else:
+            # relative to the project root, like every other path
+            self._database = os.path.join(ROOT, conf['database'])
+
+    @contextmanager
+    def connection(self):
+        '''
+        A connection whose transaction is committed on exit,
+        or rolled back if an exception was raised
+        '''
+        if self.backend == 'postgres':
+            conn = self._pool.getconn()
+            try:
+                with conn:
+                    yield conn
+            finally:
+                self._pool.putconn(conn)
+        else:
+            conn = sqlite3.connect(self._database, timeout=60)
+            try:
+                with conn:
+                    yield conn
+            finally:
+                conn.close()
+
+    def execute(self, *statements: str):
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            for statement in statements:
+                logging.debug(f'Executing {statement}')
+                cursor.execute(statement)
+
+    def tables(self) -> List[str]:
+        if self.backend == 'postgres':
+            query = "SELECT table_name FROM information_schema.tables WHERE table_schema = current_schema()"
+        else:
+            query = "SELECT name FROM sqlite_master WHERE type = 'table'"
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(query)
+            return [r[0] for r in cursor.fetchall()]
+
+    def close(self):
+        if self.backend == 'postgres':
+            self._pool.closeall()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def load_tables(conf: Dict[Any, Any], conf_out: Dict[Any, Any]):
+    '''
+    Replaces the five tables and the rollups in the configured
+    database with the normalized output tables written in the
+    conf_out format
+    '''
+    logging.debug(f'Loading tables in {sys._getframe(  ).f_code.co_name}...')
+    with Database(conf) as db, ThreadPoolExecutor(max_workers=db.workers) as executor:
+        db.execute(*[f'DROP TABLE IF EXISTS {t}' for wave in reversed(LOAD_WAVES) for t in wave])
+        db.execute(*[create_table(t, db.backend) for wave in LOAD_WAVES for t in wave])
+        for wave in LOAD_WAVES:
+            loads = [executor.submit(copy_table, db, t, read_output(t, conf, conf_out)) for t in wave]
+            for l in loads:
+                l.result()
+
+        # keys and indexes are built once the data is in place
+        if db.backend == 'postgres':
+            keys = [executor.submit(db.execute, f'ALTER TABLE {t} ADD PRIMARY KEY ({c})')
+                    for t, c in PRIMARY_KEYS.items()]
+            for k in keys:
+                k.result()
+            db.execute(*[f'ALTER TABLE {t} ADD FOREIGN KEY ({c}) REFERENCES {r} ({PRIMARY_KEYS[r]})'
+                         for t, c, r in FOREIGN_KEYS])
+        indexes = [executor.submit(db.execute, f'CREATE INDEX {t}_{c}_idx ON {t} ({c})')
+                   for t, c in INDEXES]
+        for i in indexes:
+            i.result()
+        db.execute(*[f'ANALYZE {t}' for t in SCHEMA])
+
+
+def tables_exist(conf: Dict[Any, Any]) -> bool:
+    with Database(conf) as db:
+        return set(SCHEMA) <= set(db.tables())
+
+
+def create_table(name: str, backend: str) -> str:
+    '''
+    CREATE TABLE statement; keys are declared up front on
+    sqlite, which cannot add them afterwards
+    '''
+    columns = [f'{c} {TYPES[backend][t]}' for c, t in SCHEMA[name].items()]
+    if backend == 'sqlite' and name in PRIMARY_KEYS:
+        columns.append(f'PRIMARY KEY ({PRIMARY_KEYS[name]})')
+        columns += [f'FOREIGN KEY ({c}) REFERENCES {r} ({PRIMARY_KEYS[r]})'
+                    for t, c, r in FOREIGN_KEYS if t == name]
+    return f'CREATE TABLE {name} ({", ".join(columns)})'
+
+
+def copy_table(db: Database, name: str, batches: Iterable[DataFrame]):
+    '''
+    Streams batches into a table within a single transaction
+    '''
+    rows = 0
+    with db.connection() as conn:
+        cursor = conn.cursor()
+        for df in batches:
+            df = to_schema(df, name)
+            columns = ', '.join(df.columns)
+            if db.backend == 'postgres':
+                buffer = io.StringIO()
+                df.to_csv(buffer, index=False, header=False)
+                buffer.seek(0)
+                cursor.copy_expert(f'COPY {name} ({columns}) FROM STDIN WITH (FORMAT csv)', buffer)
+            else:
+                values = df.astype(object).where(df.notnull(), None).itertuples(index=False, name=None)
+                cursor.executemany(
+                    f'INSERT INTO {name} ({columns}) VALUES ({", ".join("?" * df.shape[1])})', values)
+            rows += df.shape[0]
+    logging.debug(f'Loaded {rows} records into {name} in {sys._getframe(  ).f_code.co_name}...')
+
+
+def to_schema(df: DataFrame, name: str) -> DataFrame:
+    '''
+    Keeps the table's columns and casts them to match its
+    schema; integers stay integers when nulls are present
+    and dates are written without a time of day
+    '''
+    types = SCHEMA[name]
+    df = df.reset_index()
+    df = df[[c for c in types if c in df.columns]]
+    casts = {}
+    for c in df.columns:
+        if types[c] == 'integer':
+            casts[c] = df[c].astype('Int64')
+        elif types[c] == 'date':
+            casts[c] = pd.to_datetime(df[c]).dt.strftime('%Y-%m-%d')
+    return df.assign(**casts)
+
+
+def read_output(name: str, conf: Dict[Any, Any], conf_out: Dict[Any, Any]) -> Iterator[DataFrame]:
+    '''
+    Reads a normalized output table in batches of batch_rows
+    '''
+    fmt = conf_out['format']
+    kwargs = {'index_col': PRIMARY_KEYS.get(name), **CSV_NA} if fmt == 'csv' else {}
+    return read_table(table_path(DIR_OUTPUT, name, fmt), fmt, conf['batch_rows'], **kwargs)
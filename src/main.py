@@ -1,16 +1,40 @@
 import pandas as pd
 import numpy as np
 import json
+import sys
+import io
+import functools
+import itertools
 import os
 import logging
-from scipy.stats import expon
-from typing import Dict, NewType, Any
-from config.config import DIR_DATA, DIR_CONFIG, DIR_OUTPUT
+import time
+import cProfile
+import pstats
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, Iterator, List, NewType, Tuple, Any
+from config.config import DIR_DATA, DIR_CONFIG, DIR_OUTPUT, DIR_CACHE, DIR_STAGES, ROOT
 from util.helper import get_postal_code as gpc
-from util.helper import timer
+from util.helper import timer, rechunk
+from util.writer import TableWriter, PartitionedWriter, table_path, read_table, CSV_NA
+from util.cache import cached, cache_key, file_hash, invalidate
+from util.schema import compact, CATEGORICAL, NUMERIC
+from util import metrics
+from util.rng import set_seed
 from bootstrap import interpolate
-from transform import *
-from normalize import *
+from load import load_tables, tables_exist
+from validate import validate
+import integrity
+from polars_engine import PolarsEngine
+from pipeline import Stage
+import pipeline
+from transform import (get_shifted_order_id, get_shifted_order_date, get_shifted_ship_date,
+                       get_product_cost_to_consumer, get_return_date, get_return_quantity,
+                       get_reason_returned, get_discount, get_postal_code,
+                       get_country_code, get_salesperson)
+from normalize import (normalize_orders, normalize_products, normalize_regions,
+                       normalize_returns, normalize_customers, fold,
+                       partition_keys, returns_partition_keys, PARTITIONED, PARTITION_BY,
+                       order_facts, rollup, finish_rollup, ROLLUPS, ROLLUP_DECIMALS)
 
 DataFrame = NewType('DataFrame', pd.DataFrame)
 Series = NewType('Series', pd.Series)
@@ -25,79 +49,311 @@ products table - info about products, including some that were not ordered.
 Superstore xls pulled from here: https://community.tableau.com/thread/316509
 '''
 
+SOURCE_FILE = 'Global Superstore.xls'
+SOURCE_DTYPES = {'Order Date': 'str', 'Ship Date': 'str'}
+TABLES = ['orders', 'products', 'regions', 'returns', 'customers']
+DATE_COLUMNS = ['order_date', 'ship_date', 'return_date', 'date_rank']
+
 @timer
-def main():
+def main(refresh_cache: bool = False, force: List[str] = None, dry_run: bool = False,
+         append: bool = False, profile: bool = False, targets: List[str] = None,
+         overrides: Dict[str, Dict[str, Any]] = None):
     '''
-    Transformation pipeline
+    Transformation pipeline; only re-runs the stages
+    whose inputs changed since the last run, of targets
+    and their upstream if given. overrides replace keys of
+    the config files they are listed under. With append,
+    a rebuilt bootstrap extends the previous output. A
+    report of the run's metrics is written to the output
+    directory, and with profile a cProfile capture too
     '''
     # o = pd.read_excel(input_file, sheet_name='Orders')
     # r = pd.read_excel(input_file, sheet_name='Returns')
     # p = pd.read_excel(input_file, sheet_name='People')
 
-    logging.info(f'Reading in files from {DIR_DATA}...')
-    df = pd.read_excel(os.path.join(DIR_DATA, 'Global Superstore.xls'),
-                       dtype={
-                           'Order Date': 'str',
-                           'Ship Date': 'str'
-                       })
-
-    # Barb's original work; used to determine the needed columns
-    o = pd.read_csv(os.path.join(DIR_DATA, 'orders.csv'))
-    p = pd.read_csv(os.path.join(DIR_DATA, 'products.csv'))
-    rg = pd.read_csv(os.path.join(DIR_DATA, 'regions.csv'))
-    rt = pd.read_csv(os.path.join(DIR_DATA, 'returns.csv'))
-    c = pd.read_csv(os.path.join(DIR_DATA, 'customers.csv'))
-    df.columns = [i.replace(' ', '_').replace('-', '_').lower() for i in df.columns]
-
-    # generate columns configuration
-    conf_cols = {}
-    conf_cols['cols'] = {}
-    conf_cols['cols']['orders'] = o.columns.tolist()
-    conf_cols['cols']['products'] = p.columns.tolist()
-    conf_cols['cols']['regions'] = rg.columns.tolist()
-    conf_cols['cols']['returns'] = rt.columns.tolist()
-    conf_cols['cols']['customers'] = c.columns.tolist()
-
-    with open(os.path.join(DIR_CONFIG, 'transform.json')) as f:
-        conf_transform: Dict[Any, Any] = json.loads(f.read())
-    df_transformed = transform(df, conf_transform)
-    with open(os.path.join(DIR_CONFIG, 'bootstrap.json')) as f:
-        conf_boot: Dict[Any, Any] = json.loads(f.read())
-    df_bootstrapped = bootstrap(df_transformed, conf_boot)
-    df_dict = select_columns(df_bootstrapped, conf_cols)
-    normalize(df_dict)
+    steps = stages(refresh_cache, append, overrides)
+    if append:
+        # appended rows are only normalized on top of the previous
+        # tables, so nothing else they depend on may have changed
+        plan = {s['stage'].name: s for s in pipeline.plan(steps, force, targets)}
+        normalize_reasons = plan['normalize']['reasons'] if 'normalize' in plan else []
+        if plan['transform']['rebuild'] or set(normalize_reasons) - {'bootstrap rebuilt'}:
+            raise Exception('Only bootstrap.json may change between a run and '
+                            'its continuation; run without --append')
+    if dry_run:
+        pipeline.run(steps, force, dry_run, targets)
+        return
+
+    started = time.time()
+    profiler = cProfile.Profile() if profile else None
+    if profiler:
+        profiler.enable()
+    try:
+        pipeline.run(steps, force, dry_run, targets)
+    finally:
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats(os.path.join(DIR_OUTPUT, 'profile.prof'))
+            stats = io.StringIO()
+            pstats.Stats(profiler, stream=stats).sort_stats('cumulative').print_stats(30)
+            logging.debug(stats.getvalue())
+        metrics.write_report(os.path.join(DIR_OUTPUT, 'run_report.json'),
+                             started=started,
+                             wall_secs=time.time() - started,
+                             profile='profile.prof' if profiler else None)
 
     return
 
+def stages(refresh_cache: bool = False, append: bool = False,
+           overrides: Dict[str, Dict[str, Any]] = None) -> List[Stage]:
+    '''
+    transform -> bootstrap -> normalize, then the optional
+    validate, integrity, load and export stages, with the files
+    each stage reads and how to reload its artifact. With
+    append, bootstrap only yields the rows it adds and
+    normalize adds them to its previous output. Overridden
+    config keys are stage parameters, so that runs with and
+    without them are told apart
+    '''
+    overrides = overrides or {}
+    over_boot = overrides.get('bootstrap.json', {})
+    over_trans = overrides.get('transform.json', {})
+    conf_cache = load_config('cache.json')
+    conf_boot = load_config('bootstrap.json', over_boot)
+    conf_out = load_config('output.json')
+    conf_load = load_config('load.json')
+    conf_valid = load_config('validate.json')
+    conf_integrity = load_config('integrity.json')
+    # the export is a load into a single sqlite file
+    conf_export = {**load_config('export.json'), 'backend': 'sqlite', 'workers': 1}
+    over_engine = overrides.get('engine.json', {})
+    engine = get_engine(load_config('engine.json', over_engine))
+    # every random stream derives from the seed in bootstrap.json
+    set_seed(conf_boot.get('seed'))
+    source = functools.lru_cache(maxsize=None)(lambda: ingest(conf_cache, refresh_cache))
+
+    transformed = os.path.join(DIR_STAGES, 'transform.feather')
+    def run_transform(upstream):
+        df = transform(source()[0], load_config('transform.json', over_trans))
+        os.makedirs(DIR_STAGES, exist_ok=True)
+        df.reset_index(drop=True).to_feather(transformed)
+        return df
+
+    fidelity = os.path.join(DIR_OUTPUT, 'fidelity_report.json')
+    def run_validate(upstream):
+        # the shards bootstrap streamed were consumed by normalize, so
+        # they are streamed again from the compiled output; the first
+        # chunk holds the source rows and the rest were generated
+        report = validate(upstream['transform'], itertools.islice(load_compiled(), 1, None), conf_valid)
+        with open(fidelity, 'w') as f:
+            f.write(json.dumps(report, indent=2, default=str))
+
+    integrity_report = os.path.join(DIR_OUTPUT, 'integrity_report.json')
+    def run_integrity(upstream):
+        report = integrity.check(conf_integrity, conf_out)
+        with open(integrity_report, 'w') as f:
+            f.write(json.dumps(report, indent=2, default=str))
+        if not report['passed'] and conf_integrity['fail']:
+            raise Exception(f'Output tables violate {", ".join(report["failed"])}; '
+                            f'see {integrity_report}')
+
+    fmt = conf_boot.get('shard_format', 'csv')
+    compiled = table_path(DIR_OUTPUT, 'bootshard_compiled', fmt)
+    def load_compiled():
+        # chunks are cut where bootstrap cut them, the source rows
+        # then one per shard, as normalization depends on them
+        # floats as bootstrap streamed them on, which the default
+        # parser does not always give back
+        kwargs = {'index_col': 'id', 'parse_dates': DATE_COLUMNS,
+                  'float_precision': 'round_trip'} if fmt == 'csv' else {}
+        source_rows = pd.read_feather(transformed, columns=['row_id']).shape[0]
+        sizes = itertools.chain([source_rows], itertools.repeat(conf_boot['shard_size']))
+        chunks = read_table(compiled, fmt, conf_boot['shard_size'], **kwargs)
+        return (compact(df) for df in rechunk(chunks, sizes))
+
+    appended = []
+    def run_bootstrap(upstream):
+        appended.append(append)
+        return bootstrap(upstream['transform'], conf_boot, append)
+
+    def run_normalize(upstream):
+        if not engine.streams and upstream['bootstrap'] is not None:
+            # a bootstrap run only completes the compiled output the
+            # engine reads once its shards are consumed
+            for _ in upstream['bootstrap']:
+                pass
+        source_rows = pd.read_feather(transformed, columns=['row_id']).shape[0]
+        engine.normalize(upstream['bootstrap'], conf_boot, source_rows, source()[1],
+                         conf_out, CSV_OPTIONS, any(appended))
+
+    steps = [
+        Stage('transform',
+              run_transform,
+              lambda: pd.read_feather(transformed),
+              lambda: os.path.exists(transformed),
+              inputs=[os.path.join(DIR_DATA, SOURCE_FILE),
+                      os.path.join(DIR_CONFIG, 'transform.json'),
+                      os.path.join(DIR_CONFIG, 'discounts.json')],
+              params={'seed': conf_boot.get('seed'), **over_trans}),
+        Stage('bootstrap',
+              run_bootstrap,
+              # engines which read the compiled output need no reload
+              load_compiled if engine.streams else lambda: None,
+              lambda: os.path.exists(compiled),
+              inputs=[os.path.join(DIR_CONFIG, 'bootstrap.json')],
+              upstream=['transform'],
+              params=over_boot),
+        Stage('normalize',
+              run_normalize,
+              lambda: None,
+              lambda: all(os.path.exists(table_path(DIR_OUTPUT, t, conf_out['format'])) for t in TABLES + list(ROLLUPS)),
+              inputs=[os.path.join(DIR_CONFIG, 'output.json'),
+                      os.path.join(DIR_CONFIG, 'engine.json'),
+                      os.path.join(DIR_CONFIG, 'regions.json'),
+                      os.path.join(DIR_CONFIG, 'country_codes.json')] +\
+                     [os.path.join(DIR_DATA, f'{t}.csv') for t in TABLES],
+              upstream=['bootstrap'],
+              params=over_engine)
+    ]
+    if conf_valid['enabled']:
+        steps.append(Stage('validate',
+                           run_validate,
+                           lambda: None,
+                           lambda: os.path.exists(fidelity),
+                           inputs=[os.path.join(DIR_CONFIG, 'validate.json')],
+                           upstream=['transform', 'bootstrap']))
+    if conf_integrity['enabled']:
+        steps.append(Stage('integrity',
+                           run_integrity,
+                           lambda: None,
+                           lambda: os.path.exists(integrity_report),
+                           inputs=[os.path.join(DIR_CONFIG, 'integrity.json')],
+                           upstream=['normalize']))
+    if conf_load['enabled']:
+        # tables are only loaded once they passed the integrity check
+        steps.append(Stage('load',
+                           lambda upstream: load(conf_load, conf_out),
+                           lambda: None,
+                           lambda: tables_exist(conf_load),
+                           inputs=[os.path.join(DIR_CONFIG, 'load.json')],
+                           upstream=['normalize'] + (['integrity'] if conf_integrity['enabled'] else [])))
+    if conf_export['enabled']:
+        steps.append(Stage('export',
+                           lambda upstream: load(conf_export, conf_out),
+                           lambda: None,
+                           lambda: os.path.exists(os.path.join(ROOT, conf_export['database']))
+                                   and tables_exist(conf_export),
+                           inputs=[os.path.join(DIR_CONFIG, 'export.json')],
+                           upstream=['normalize'] + (['integrity'] if conf_integrity['enabled'] else [])))
+    return steps
+
+class PandasEngine:
+    '''
+    The default engine; normalizes bootstrap's chunks in
+    memory as they stream in
+    '''
+    name = 'pandas'
+    streams = True
+
+    def __init__(self, conf: Dict[str, Any]):
+        self.conf = conf
+
+    def normalize(self, chunks: Iterable[DataFrame], conf_boot: Dict[str, Any], source_rows: int,
+                  conf_cols: Dict, conf_out: Dict[str, Any], csv_options: Dict[str, Dict[str, str]],
+                  append: bool = False):
+        normalize((select_columns(enrich(s), conf_cols) for s in chunks), conf_out, append)
+
+# dataframe engines normalize runs on; transform and bootstrap work on
+# the source rows, which fit in memory, and always run on pandas
+ENGINES = {'pandas': PandasEngine, 'polars': PolarsEngine}
+
+def get_engine(conf: Dict[str, Any]):
+    if conf['name'] not in ENGINES:
+        raise ValueError(f'Unknown engine {conf["name"]!r}, expected one of {sorted(ENGINES)}')
+    return ENGINES[conf['name']](conf)
+
+def load_config(name: str, overrides: Dict[str, Any] = None) -> Dict[Any, Any]:
+    with open(os.path.join(DIR_CONFIG, name)) as f:
+        return {**json.loads(f.read()), **(overrides or {})}
+
+@timer
+def ingest(conf: Dict[Any, Any], refresh: bool = False) -> Tuple[DataFrame, Dict]:
+    '''
+    Reads the source workbook and the output columns
+    configuration, from the ingestion cache when the
+    source files have not changed
+    '''
+    logging.info(f'Reading in files from {DIR_DATA}...')
+    source = os.path.join(DIR_DATA, SOURCE_FILE)
+    references = [os.path.join(DIR_DATA, f'{t}.csv') for t in TABLES]
+
+    def read_source():
+        df = pd.read_excel(source, dtype=SOURCE_DTYPES)
+        df.columns = [i.replace(' ', '_').replace('-', '_').lower() for i in df.columns]
+        return compact(df), {}
+
+    def read_columns():
+        # Barb's original work; used to determine the needed columns
+        return None, {'cols': {t: pd.read_csv(r, nrows=0).columns.tolist()
+                               for t, r in zip(TABLES, references)}}
+
+    if not conf['enabled']:
+        return read_source()[0], read_columns()[1]
+    if refresh:
+        invalidate(DIR_CACHE)
+    df, _ = cached(DIR_CACHE,
+                   cache_key(file_hash(source), SOURCE_DTYPES, CATEGORICAL, NUMERIC),
+                   read_source,
+                   conf['format'],
+                   conf['max_bytes'])
+    _, conf_cols = cached(DIR_CACHE,
+                          cache_key(*[file_hash(r) for r in references]),
+                          read_columns,
+                          conf['format'],
+                          conf['max_bytes'])
+    return df, conf_cols
+
 @timer
 def transform(df: DataFrame, conf: Dict[Any, Any]) -> DataFrame:
     '''
     Modification of fields in-place
     '''
     logging.info(f'Beginning transformation...')
-    out = df.copy()
+    # new columns only; the source columns are shared with df
+    out = df.copy(deep=False)
 
     out['order_id'] = get_shifted_order_id(df, conf)
     out['order_date'] = get_shifted_order_date(df, conf)
     out['ship_date'] = get_shifted_ship_date(df, conf)
     out['product_cost_to_consumer'] = get_product_cost_to_consumer(df)
-    out['country_code'] = get_country_code(df)
-    out['salesperson'] = get_salesperson(df)
     out['return_date'] = get_return_date(out, conf)
     out['return_quantity'] = get_return_quantity(df)
     out['reason_returned'] = get_reason_returned(df)
     out['discount'] = get_discount(df)
     out['postal_code'] = get_postal_code(df)
 
-    return out
+    return compact(out)
 
 @timer
-def bootstrap(df: DataFrame, conf: Dict[Any, Any]) -> DataFrame:
+def bootstrap(df: DataFrame, conf: Dict[Any, Any], append: bool = False) -> Iterator[DataFrame]:
     '''
-    Creation of new data
+    Creation of new data; shards are generated lazily
+    as the downstream stages consume them
     '''
     logging.info(f'Beginning bootstrap...')
-    return interpolate(df, conf)
+    return interpolate(df, conf, append)
+
+@timer
+def enrich(df: DataFrame) -> DataFrame:
+    '''
+    Lookups against the reference configs; applied per chunk
+    after bootstrapping so that changing those configs does
+    not require the rows to be regenerated
+    '''
+    # chunks are shared with bootstrap, which samples from the
+    # source rows, so they are left unmodified
+    return compact(df.assign(country_code=get_country_code(df),
+                             salesperson=get_salesperson(df)))
 
 @timer
 def select_columns(df: DataFrame, conf: Dict) -> DataFrame:
@@ -105,35 +361,112 @@ def select_columns(df: DataFrame, conf: Dict) -> DataFrame:
     Cull output columns
     '''
     logging.info(f'Beginning column selection...')
-    out = df.copy()
-    dfs = {k: out.loc[:, out.columns.intersection(v)].reindex()\
-           for k, v in conf['cols'].items()}
+    dfs = {k: df[df.columns.intersection(v)] for k, v in conf['cols'].items()}
 
     return dfs
 
 @timer
-def normalize(dfs: Dict[str, DataFrame]):
+def normalize(chunks: Iterable[Dict[str, DataFrame]], conf: Dict[Any, Any], append: bool = False):
     '''
-    Normalize and link tables
+    Normalize and link tables. Orders and returns are
+    written chunk by chunk; regions, products and customers
+    are folded across chunks and written at the end, as are
+    the rollups of the orders, summed chunk by chunk. Tables
+    are written in parallel in the configured output format,
+    orders and returns partitioned by year and region if
+    configured. With append, the chunks are added to the
+    tables already written, which are folded into rather
+    than rebuilt
     '''
     logging.info(f'Beginning normalization...')
-    # generate regions and regions join key to orders
-    regions, cjk = normalize_regions(dfs['regions'], gpc)
-    regions.to_csv(os.path.join(DIR_OUTPUT, 'regions.csv'), float_format='%.0f')
-    # pass regions join key into orders normalization
-    normalize_orders(dfs['orders'], cjk).to_csv(os.path.join(DIR_OUTPUT, 'orders.csv'), float_format='%.2f')
-    dfs['orders'].to_csv('./tmp_orders.csv')
-    normalize_products(dfs['products']).to_csv(os.path.join(DIR_OUTPUT, 'products.csv'), float_format='%.2f')
-    dfs['regions'].to_csv('./tmp_regions.csv')
-    normalize_returns(dfs['returns']).to_csv(os.path.join(DIR_OUTPUT, 'returns.csv'))
-    normalize_customers(dfs['customers']).to_csv(os.path.join(DIR_OUTPUT, 'customers.csv'))
-    logging.info(f'Successfully wrote files to ./{DIR_OUTPUT}')
+    regions = products = customers = None
+    rollups = {k: None for k in ROLLUPS}
+    if append:
+        regions = read_output('regions', 'id', conf)
+        products = read_output('products', 'product_id', conf)
+        customers = read_output('customers', 'customer_id', conf)
+        rollups = {k: read_output(k, None, conf) for k in ROLLUPS}
+    mode = 'a' if append else 'w'
+    with ThreadPoolExecutor(max_workers=conf['workers']) as executor,\
+         open_table('orders', conf, mode) as orders_out,\
+         open_table('returns', conf, mode) as returns_out:
+        for dfs in chunks:
+            # extend regions and generate regions join key to orders
+            regions, cjk = normalize_regions(dfs['regions'], gpc, regions)
+            # pass regions join key into orders normalization
+            # generated order ids never repeat across chunks
+            orders = normalize_orders(dfs['orders'], cjk)
+            returns = normalize_returns(dfs['returns'])
+            # the chunk's sums are merged into those of the chunks before
+            facts = order_facts(orders, returns, regions, dfs['products'], dfs['customers'])
+            rollups = {k: rollup(facts, by, rollups[k]) for k, by in ROLLUPS.items()}
+            if conf.get('partitioned'):
+                returns = returns.join(returns_partition_keys(returns, orders, regions))
+                orders = orders.join(partition_keys(orders, regions))
+            writes = [
+                executor.submit(orders_out.write, orders),
+                executor.submit(returns_out.write, returns)
+            ]
+            products = fold(normalize_products, products, dfs['products'])
+            customers = fold(normalize_customers, customers, dfs['customers'])
+            for w in writes:
+                w.result()
+        dims = {'regions': regions, 'products': products, 'customers': customers,
+                **{k: finish_rollup(v, ROLLUPS[k]) for k, v in rollups.items()}}
+        for w in [executor.submit(write_table, k, v, conf) for k, v in dims.items()]:
+            w.result()
+    logging.info(f'Successfully wrote files to {DIR_OUTPUT}')
+
+@timer
+def load(conf: Dict[Any, Any], conf_out: Dict[Any, Any]):
+    '''
+    Bulk load of the normalized tables into the
+    configured database
+    '''
+    logging.info(f'Beginning load into {conf["backend"]}...')
+    load_tables(conf, conf_out)
+    logging.info(f'Successfully loaded tables into {conf["backend"]}')
+
+# csv formatting of each output table
+CSV_OPTIONS: Dict[str, Dict[str, str]] = {
+    'regions': {'float_format': '%.0f'},
+    'orders': {'float_format': '%.2f'},
+    'products': {'float_format': '%.2f'},
+    'returns': {},
+    'customers': {},
+    **{k: {'float_format': f'%.{ROLLUP_DECIMALS}f', 'index': False} for k in ROLLUPS}
+}
+
+def open_table(name: str, conf: Dict[Any, Any], mode: str = 'w') -> TableWriter:
+    '''
+    Opens a normalized output table in the configured format
+    '''
+    fmt = conf['format']
+    if fmt == 'csv':
+        kwargs = CSV_OPTIONS[name]
+    else:
+        kwargs = {'compression': conf['compression'],
+                  'row_group_size': conf['row_group_size']}
+    path = table_path(DIR_OUTPUT, name, fmt)
+    if conf.get('partitioned') and name in PARTITIONED:
+        return PartitionedWriter(path, fmt, PARTITION_BY, mode, conf['workers'], **kwargs)
+    return TableWriter(path, fmt, mode, **kwargs)
+
+def write_table(name: str, df: DataFrame, conf: Dict[Any, Any]):
+    with open_table(name, conf) as out:
+        out.write(df)
+
+def read_output(name: str, index: str, conf: Dict[Any, Any]) -> DataFrame:
+    '''
+    Reads a normalized output table back in full
+    '''
+    fmt = conf['format']
+    kwargs = {'index_col': index, 'parse_dates': [c for c in ['month'] if c in ROLLUPS.get(name, [])],
+              **CSV_NA} if fmt == 'csv' else {}
+    return pd.concat(read_table(table_path(DIR_OUTPUT, name, fmt), fmt, **kwargs))
 
 if __name__ == '__main__':
 
-    logging.basicConfig(
-        level=logging.DEBUG,
-        filename='out.log',
-        format='%(asctime)s %(message)s',
-        datefmt='%m/%d/%Y %I:%M:%S %p')
-    main()
+    # kept for running main.py directly; src/cli.py is the entry point
+    import cli
+    sys.exit(cli.run())
@@ -1,15 +1,36 @@
 import sys
 import logging
 import pandas as pd
-from typing import Dict, NewType
+import numpy as np
+from typing import Dict, List, NewType
+from util.helper import timer
 
 DataFrame = NewType('DataFrame', pd.DataFrame)
 Series = NewType('Series', pd.Series)
 
+# composite key identifying a region
+REGION_KEYS = ['region', 'country', 'state', 'city', 'salesperson']
+# tables written partitioned when configured, and the columns they are
+# partitioned by
+PARTITIONED = ['orders', 'returns']
+PARTITION_BY = ['order_year', 'region']
+# rollups of the order rows, by the columns they are grouped by
+ROLLUPS: Dict[str, List[str]] = {
+    'sales_by_month_region_sub_category': ['month', 'region', 'sub_category'],
+    'sales_by_segment': ['segment']
+}
+# summed columns of a rollup, from which its averages are derived; sums
+# of parts add up to the sum of the whole, so rollups of each chunk are
+# merged rather than recomputed
+ROLLUP_SUMS = ['order_lines', 'returned_lines', 'sales', 'profit', 'discount_sum']
+# decimals of the measures summed, at which their sums are exact
+ROLLUP_DECIMALS = 4
+
 ########
 # Orders
 ########
 
+@timer
 def normalize_orders(df: DataFrame, cjk: DataFrame) -> DataFrame:
     logging.debug(f'Normalizing data in {sys._getframe(  ).f_code.co_name}...')
     df.index.name = 'id'
@@ -22,20 +43,11 @@ def normalize_orders(df: DataFrame, cjk: DataFrame) -> DataFrame:
 ##########
 
 
+@timer
 def normalize_products(df: DataFrame) -> DataFrame:
     logging.debug(f'Normalizing data in {sys._getframe(  ).f_code.co_name}...')
-    res: Dict[str, list] = {}
-    cols: List[str] = df.columns
-    # descend into groupby object
-    for r in df.copy().groupby('product_id'):
-        # iterate through nested series object
-        for sr in r[1].iterrows():
-            # if cost to consumer isn't null, update res key
-            if not pd.isnull(sr[1].loc['product_cost_to_consumer']):
-                res[r[0]] = sr[1].tolist()
-    out_df = pd.DataFrame(data=res).T
-    out_df.columns = cols
-    out_df.set_index('product_id', inplace=True)
+    # last row per product with a non-null cost to consumer
+    out_df = last_by_key(df[df['product_cost_to_consumer'].notnull()], 'product_id')
     logging.debug(f'Returned {out_df.shape[0]} records in {sys._getframe(  ).f_code.co_name}...')
     return out_df
 
@@ -43,30 +55,37 @@ def normalize_products(df: DataFrame) -> DataFrame:
 # Regions
 #########
 
-def normalize_regions(df: DataFrame, gpc) -> DataFrame:
+@timer
+def normalize_regions(df: DataFrame, gpc, regions: DataFrame = None) -> DataFrame:
+    '''
+    Builds the regions table and the orders to region_id join
+    key. Region ids are dense and follow the sorted region keys.
+    If regions from previous chunks are passed in, their ids are
+    kept and unseen regions are appended after them
+    '''
     logging.debug(f'Normalizing data in {sys._getframe(  ).f_code.co_name}...')
-    res_gb = df.copy().groupby(['region', 'country', 'state',\
-                             'city', 'salesperson']).max().reset_index()
-
-    # create order_id composite join table
-    dfoc = df.copy()
-    dfoc.to_csv('./tmp_dfoc.csv')
-    dfoid = pd.DataFrame({
-        'cjk': dfoc['region'] + dfoc['country'] + dfoc['state'] + dfoc['city'] + dfoc['salesperson'],
-        'orders_id': dfoc.index
-    })
-    dfoid['cjk'] = dfoid['cjk'].apply(lambda x: hash(x))
-
-    # create region_id composite join table
-    dfrgb = df.copy().groupby(['region', 'country', 'state', 'city', 'salesperson']).max().reset_index()
-    dfrid = pd.DataFrame({
-        'cjk': dfrgb['region'] + dfrgb['country'] + dfrgb['state'] + dfrgb['city'] + dfrgb['salesperson'],
-        'region_id': dfrgb.index
-    })
-    dfrid['cjk'] = dfrid['cjk'].apply(lambda x: hash(x))
-
-    # left join order_id to region_id to create composite join index
-    dfcjk = pd.merge(dfoid, dfrid, how='left', on='cjk').drop('cjk', axis=1)
+    # one row per distinct region with the max of every other column,
+    # and the position of each order row's region among them
+    codes = df.groupby(REGION_KEYS, observed=True).ngroup().fillna(-1).values.astype('int64')
+    cols = REGION_KEYS + [c for c in df.columns if c not in REGION_KEYS]
+    dfrgb = max_by_index(df.loc[codes >= 0, cols].set_axis(codes[codes >= 0], axis=0))
+
+    if regions is None:
+        ids = np.arange(dfrgb.shape[0])
+    else:
+        ids = dfrgb[REGION_KEYS].merge(
+            regions[REGION_KEYS].reset_index(), how='left', on=REGION_KEYS)['id']
+        ids = ids.fillna(-1).to_numpy(dtype='int64', copy=True)
+        unseen = ids < 0
+        ids[unseen] = regions.shape[0] + np.arange(unseen.sum())
+    dfrgb.index = ids
+    if regions is not None:
+        dfrgb = max_by_index(pd.concat([regions, dfrgb]))
+
+    # orders join key; rows with a null region key get a null region_id
+    region_id = pd.array(ids[codes], dtype='Int64')
+    region_id[codes < 0] = pd.NA
+    dfcjk = pd.DataFrame({'region_id': region_id}, index=df.index.rename('orders_id'))
 
     # lookup postal codes and set index
     dfrgb['postal_code'] = gpc(dfrgb)
@@ -79,21 +98,13 @@ def normalize_regions(df: DataFrame, gpc) -> DataFrame:
 # Returns
 #########
 
+@timer
 def normalize_returns(df: DataFrame) -> DataFrame:
     logging.debug(f'Normalizing data in {sys._getframe(  ).f_code.co_name}...')
-    res: Dict[str, list] = {}
-    cols: List[str] = df.columns
-    # descend into groupby object
-    for r in df.copy().groupby('order_id'):
-        # iterate through nested series object
-        for sr in r[1].iterrows():
-            # singleton return row
-            res[r[0]] = sr[1].tolist()
-    out_df = pd.DataFrame(data=res).T
-    out_df.columns = cols
-    out_df.set_index('order_id', inplace=True)
+    # singleton return row
+    out_df = last_by_key(df, 'order_id')
     # return only rows where return qty > 0
-    out_df = out_df.copy()[ out_df['return_quantity']  > 0 ]
+    out_df = out_df[ out_df['return_quantity']  > 0 ]
     logging.debug(f'Returned {out_df.shape[0]} records in {sys._getframe(  ).f_code.co_name}...')
     return out_df
 
@@ -101,20 +112,115 @@ def normalize_returns(df: DataFrame) -> DataFrame:
 # Customers
 ###########
 
+@timer
 def normalize_customers(df: DataFrame) -> DataFrame:
     logging.debug(f'Normalizing data in {sys._getframe(  ).f_code.co_name}...')
-    res: Dict[str, list] = {}
-    cols: List[str] = df.columns
-    # descend into groupby object
-    for r in df.copy().groupby('customer_id'):
-        # iterate through nested series object
-        for sr in r[1].iterrows():
-            # singleton return row
-            res[r[0]] = sr[1].tolist()
-    out_df = pd.DataFrame(data=res).T
-    out_df.columns = cols
-    out_df.set_index('customer_id', inplace=True)
+    # singleton customer row
+    out_df = last_by_key(df, 'customer_id')
     # drop postal_code because this is duplicated in regions df
-    out_df.drop(labels=['postal_code'], axis=1, inplace=True)
+    out_df = out_df.drop(labels=['postal_code'], axis=1)
     logging.debug(f'Returned {out_df.shape[0]} records in {sys._getframe(  ).f_code.co_name}...')
     return out_df
+
+############
+# Partitions
+############
+
+def partition_keys(orders: DataFrame, regions: DataFrame) -> DataFrame:
+    '''
+    Year and region of each order row, taken from its order
+    date and its region_id's row of regions
+    '''
+    ids = orders['region_id'].fillna(-1).to_numpy(dtype='int64')
+    return pd.DataFrame({'order_year': orders['order_date'].dt.year.astype('Int64'),
+                         'region': regions['region'].reindex(ids).to_numpy()},
+                        index=orders.index)
+
+def returns_partition_keys(returns: DataFrame, orders: DataFrame, regions: DataFrame) -> DataFrame:
+    '''
+    Year and region of the order row each return was taken
+    from, the last of its order id, as in normalize_returns
+    '''
+    last = orders.drop_duplicates('order_id', keep='last').set_index('order_id')
+    return partition_keys(last, regions).reindex(returns.index)
+
+#########
+# Rollups
+#########
+
+def order_facts(orders: DataFrame, returns: DataFrame, regions: DataFrame,
+                products: DataFrame, customers: DataFrame) -> DataFrame:
+    '''
+    Rollup keys and measures of a chunk's order rows, from the
+    chunk's tables before normalization, which share its rows,
+    so each row keeps the sub-category and segment it was drawn
+    with. A row is returned if its order id is among the
+    chunk's returns, as joining the output tables would find
+    '''
+    return pd.DataFrame({
+        'month': orders['order_date'].dt.to_period('M').dt.to_timestamp(),
+        'region': partition_keys(orders, regions)['region'],
+        'sub_category': products['sub_category'],
+        'segment': customers['segment'],
+        'order_lines': 1,
+        'returned_lines': orders['order_id'].isin(returns.index).astype('int64'),
+        'sales': orders['sales'],
+        'profit': orders['profit'],
+        'discount_sum': orders['discount']
+    }, index=orders.index)
+
+@timer
+def rollup(facts: DataFrame, by: List[str], state: DataFrame = None) -> DataFrame:
+    '''
+    Sums of a chunk's facts by the columns by, merged into the
+    sums of the previous chunks if given
+    '''
+    partial = facts.groupby(by, dropna=False, observed=True)[ROLLUP_SUMS].sum().reset_index()
+    if state is not None:
+        partial = pd.concat([state[by + ROLLUP_SUMS], partial], ignore_index=True)\
+            .groupby(by, dropna=False, observed=True)[ROLLUP_SUMS].sum().reset_index()
+    return partial
+
+def finish_rollup(df: DataFrame, by: List[str]) -> DataFrame:
+    '''
+    Averages of a rollup's sums, rows sorted by its keys. Sums
+    are rounded to the decimals of their measures first, so the
+    order they were added in does not show
+    '''
+    df = df.round({c: ROLLUP_DECIMALS for c in ['sales', 'profit', 'discount_sum']})
+    return df.assign(discount=df['discount_sum'] / df['order_lines'],
+                     return_rate=df['returned_lines'] / df['order_lines'])\
+        .sort_values(by, na_position='last', kind='stable', ignore_index=True)
+
+########
+# Chunks
+########
+
+def max_by_index(df: DataFrame) -> DataFrame:
+    '''
+    Column-wise max of the rows sharing an index label, sorted
+    by label; same as groupby(level=0).max() but without the
+    per-group python fallback for string columns
+    '''
+    out = {}
+    for col in df.columns:
+        s = df[col].sort_values(na_position='first', kind='stable')
+        out[col] = s[~s.index.duplicated(keep='last')]
+    return pd.DataFrame(out).sort_index()
+
+def last_by_key(df: DataFrame, key: str) -> DataFrame:
+    '''
+    Keeps the last row for each non-null key, indexed and
+    sorted by key
+    '''
+    return df[df[key].notnull()].drop_duplicates(key, keep='last')\
+        .set_index(key).sort_index()
+
+def fold(normalizer, state: DataFrame, df: DataFrame) -> DataFrame:
+    '''
+    Folds a chunk into a normalized table by re-normalizing
+    the previous result with the chunk appended after it
+    '''
+    if state is None:
+        return normalizer(df)
+    return normalizer(pd.concat([state.reset_index(), df], ignore_index=True))
@@ -0,0 +1,185 @@
+import os
+import json
+import hashlib
+import logging
+from typing import Any, Callable, Dict, Iterator, List, NamedTuple
+from util.cache import file_hash
+from util import metrics
+from config.config import DIR_STAGES, ROOT
+
+'''
+Incremental stage runner. Each stage is fingerprinted from the
+content of its input files, its extra parameters and the
+fingerprints of its upstream stages. A stage is re-run only when
+its fingerprint differs from the one recorded by the last
+successful run or its artifact is gone; otherwise its result is
+reloaded from that artifact, and only if a downstream stage
+needs it.
+'''
+
+MANIFEST = 'manifest.json'
+
+
+class Stage(NamedTuple):
+    '''
+    run receives the results of the upstream stages by name and
+    persists the stage's artifact; load reproduces the result from
+    that artifact and exists reports whether it is still on disk
+    '''
+    name: str
+    run: Callable[[Dict[str, Any]], Any]
+    load: Callable[[], Any]
+    exists: Callable[[], bool]
+    inputs: List[str] = []
+    upstream: List[str] = []
+    params: Dict[str, Any] = {}
+
+
+def plan(stages: List[Stage], force: List[str] = None, targets: List[str] = None) -> List[Dict[str, Any]]:
+    '''
+    Works out which stages need to re-run and why. Stages must
+    be listed after their upstream stages; force names stages to
+    re-run regardless, an empty list forces every stage. With
+    targets, only those stages and their upstream are planned
+    '''
+    manifest = read_manifest()
+    steps: Dict[str, Dict[str, Any]] = {}
+    for stage in upstream_of(stages, targets):
+        # recorded relative to the project root, which may move
+        inputs = {os.path.relpath(path, ROOT): file_hash(path) for path in stage.inputs}
+        upstream = {u: steps[u]['fingerprint'] for u in stage.upstream}
+        fingerprint = hashlib.sha256(json.dumps(
+            [stage.name, inputs, upstream, stage.params], sort_keys=True, default=str
+        ).encode()).hexdigest()
+
+        previous = manifest.get(stage.name)
+        reasons = []
+        if force is not None and (not force or stage.name in force):
+            reasons.append('forced')
+        if previous is None:
+            reasons.append('never run')
+        else:
+            reasons += [f'{os.path.basename(p)} changed' for p, h in inputs.items()
+                        if previous['inputs'].get(p) != h]
+            reasons += [f'{u} rebuilt' for u in stage.upstream if steps[u]['rebuild']]
+            if previous['params'] != json.loads(json.dumps(stage.params, default=str)):
+                reasons.append('parameters changed')
+            if previous['fingerprint'] != fingerprint and not reasons:
+                reasons.append('inputs changed')
+        if not stage.exists():
+            reasons.append('artifact missing')
+
+        steps[stage.name] = {
+            'stage': stage,
+            'fingerprint': fingerprint,
+            'inputs': inputs,
+            'rebuild': bool(reasons),
+            'reasons': reasons
+        }
+    return list(steps.values())
+
+
+def run(stages: List[Stage], force: List[str] = None, dry_run: bool = False,
+        targets: List[str] = None) -> Dict[str, Any]:
+    '''
+    Runs the stages whose fingerprints changed, of targets and
+    their upstream if given. Fingerprints are recorded once every
+    stage has completed, as streamed stages only finish when their
+    consumers do; those of the stages re-run are dropped first,
+    so the partial artifact of a failed run is never taken as up
+    to date. A streamed stage without a consumer is run to
+    completion at the end. For the same reason the metrics of a
+    streamed stage only cover setting it up, its work is timed
+    within the stages consuming it
+    '''
+    steps = plan(stages, force, targets)
+    logging.info(report(steps))
+    if dry_run:
+        print(report(steps))
+        return {}
+
+    manifest = read_manifest()
+    for step in steps:
+        if step['rebuild']:
+            manifest.pop(step['stage'].name, None)
+    write_manifest(manifest)
+
+    by_name = {s.name: s for s in stages}
+    results: Dict[str, Any] = {}
+
+    def get(name):
+        if name not in results:
+            logging.info(f'Loading {name} from its last run...')
+            with metrics.measure(f'stage.{name}', action='load'):
+                results[name] = by_name[name].load()
+        return results[name]
+
+    for step in steps:
+        stage = step['stage']
+        if step['rebuild']:
+            upstream = {u: get(u) for u in stage.upstream}
+            with metrics.measure(f'stage.{stage.name}', action='run', reasons=step['reasons']):
+                results[stage.name] = stage.run(upstream)
+    for step in steps:
+        result = results.get(step['stage'].name)
+        if step['rebuild'] and isinstance(result, Iterator):
+            with metrics.measure(f'stage.{step["stage"].name}', action='drain'):
+                for _ in result:
+                    pass
+
+    manifest = read_manifest()
+    for step in steps:
+        if step['rebuild']:
+            stage = step['stage']
+            manifest[stage.name] = {
+                'fingerprint': step['fingerprint'],
+                'inputs': step['inputs'],
+                'params': json.loads(json.dumps(stage.params, default=str))
+            }
+    write_manifest(manifest)
+    return results
+
+
+def report(steps: List[Dict[str, Any]]) -> str:
+    '''
+    What would rebuild, one line per stage
+    '''
+    lines = []
+    for step in steps:
+        status = 'rebuild' if step['rebuild'] else 'up to date'
+        reasons = f' ({", ".join(step["reasons"])})' if step['reasons'] else ''
+        lines.append(f'{step["stage"].name:<12} {status}{reasons}')
+    return '\n'.join(lines)
+
+
+def upstream_of(stages: List[Stage], targets: List[str] = None) -> List[Stage]:
+    '''
+    The targets and every stage they depend on, in order
+    '''
+    if targets is None:
+        return stages
+    by_name = {s.name: s for s in stages}
+    unknown = set(targets) - set(by_name)
+    if unknown:
+        raise ValueError(f'Unknown or disabled stages {sorted(unknown)}')
+    needed, pending = set(), list(targets)
+    while pending:
+        name = pending.pop()
+        if name not in needed:
+            needed.add(name)
+            pending += by_name[name].upstream
+    return [s for s in stages if s.name in needed]
+
+
+def read_manifest() -> Dict[str, Any]:
+    path = os.path.join(DIR_STAGES, MANIFEST)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.loads(f.read())
+
+
+def write_manifest(manifest: Dict[str, Any]):
+    os.makedirs(DIR_STAGES, exist_ok=True)
+    with open(os.path.join(DIR_STAGES, MANIFEST), 'w') as f:
+        f.write(json.dumps(manifest, indent=2, sort_keys=True))
@@ -0,0 +1,290 @@
+import os
+import csv
+import shutil
+import logging
+import pandas as pd
+from typing import Any, Dict, Iterable, List, NewType
+from config.config import DIR_OUTPUT
+from normalize import REGION_KEYS, PARTITIONED, PARTITION_BY, ROLLUPS, ROLLUP_SUMS, ROLLUP_DECIMALS
+from util.reference import country_codes, salespeople
+from util.schema import CATEGORICAL, NUMERIC
+from util.writer import table_path, part_path, partition_path, write_manifest, jsonable
+
+DataFrame = NewType('DataFrame', pd.DataFrame)
+
+'''
+Polars backend of enrich -> select_columns -> normalize. Rather
+than folding bootstrap's chunks in memory, the compiled output is
+scanned lazily once bootstrap has written it, and each normalized
+table is a query which polars optimizes, runs across threads and
+streams to disk, so the tables never have to fit in memory.
+Partitioned tables are built once into a scratch file, which a
+query per partition then filters, all run together. Rollups are
+grouped from the same scan in one pass each.
+
+Tables hold the same rows as the pandas engine's: region ids and
+returns follow the chunks bootstrap cut, which are recovered from
+row positions. Requires polars 1.23 or later.
+'''
+
+# text columns, read as such however they look
+TEXT_COLUMNS = CATEGORICAL + ['order_id', 'customer_id', 'customer_name',
+                              'product_id', 'product_name']
+
+
+class PolarsEngine:
+    '''
+    threads caps the threads polars runs on; it is only read
+    when polars is first imported
+    '''
+    name = 'polars'
+    # reads bootstrap's compiled output rather than its chunks
+    streams = False
+
+    def __init__(self, conf: Dict[str, Any]):
+        if conf.get('threads'):
+            os.environ.setdefault('POLARS_MAX_THREADS', str(conf['threads']))
+        try:
+            import polars  # noqa: F401
+        except ImportError as e:
+            raise ImportError('The polars engine requires polars; '
+                              'install it or set engine.json name to "pandas"') from e
+        self.conf = conf
+
+    def normalize(self, chunks: Iterable[DataFrame], conf_boot: Dict[str, Any], source_rows: int,
+                  conf_cols: Dict, conf_out: Dict[str, Any], csv_options: Dict[str, Dict[str, str]],
+                  append: bool = False):
+        '''
+        Normalizes the compiled output of bootstrap into the
+        five tables and the rollups, once it is complete;
+        chunks are not read
+        '''
+        import polars as pl
+        if append:
+            raise Exception('The polars engine rebuilds every table from the compiled '
+                            'output; run without --append or with the pandas engine')
+        logging.info(f'Beginning normalization with polars...')
+        lf = enrich(scan_compiled(conf_boot), conf_boot, source_rows)
+        names = lf.collect_schema().names()
+        cols = {t: [c for c in names if c in v] for t, v in conf_cols['cols'].items()}
+
+        regions = normalize_regions(lf, cols['regions'])
+        keys = partition_keys() if conf_out.get('partitioned') else []
+        tables = {
+            'orders': normalize_orders(lf, cols['orders'], regions, keys),
+            'returns': normalize_returns(lf, cols['returns'], keys),
+            'products': last_by_key(lf.filter(pl.col('product_cost_to_consumer').is_not_null()),
+                                    cols['products'], 'product_id'),
+            'customers': last_by_key(lf, [c for c in cols['customers'] if c != 'postal_code'],
+                                     'customer_id'),
+            'regions': regions,
+            **{k: rollup(lf, by) for k, by in ROLLUPS.items()}
+        }
+        if conf_out['format'] == 'csv':
+            # written as text by the pandas engine, see get_postal_code
+            tables['regions'] = regions.with_columns(pl.col('postal_code').cast(pl.Utf8))
+        for name, table in tables.items():
+            partition_by = PARTITION_BY if keys and name in PARTITIONED else None
+            sink(table, name, conf_out, csv_options[name], partition_by)
+            logging.debug(f'Wrote {name} to {table_path(DIR_OUTPUT, name, conf_out["format"])}')
+        logging.info(f'Successfully wrote files to {DIR_OUTPUT}')
+
+
+def scan_compiled(conf_boot: Dict[str, Any]):
+    import polars as pl
+    fmt = conf_boot.get('shard_format', 'csv')
+    path = table_path(DIR_OUTPUT, 'bootshard_compiled', fmt)
+    if fmt == 'csv':
+        with open(path) as f:
+            header = next(csv.reader(f))
+        lf = pl.scan_csv(path, try_parse_dates=True,
+                         schema_overrides={c: pl.Utf8 for c in TEXT_COLUMNS if c in header})
+    else:
+        lf = pl.scan_parquet(os.path.join(path, '*.parquet'))
+    names = lf.collect_schema().names()
+    # integers as compact casts them
+    return lf.with_columns(
+        pl.col(pl.Categorical).cast(pl.Utf8),
+        *[pl.col(c).cast(getattr(pl, t.capitalize())) for c, t in NUMERIC.items()
+          if c in names and t.startswith('int')])
+
+
+def enrich(lf, conf_boot: Dict[str, Any], source_rows: int):
+    '''
+    Adds the reference lookups, as enrich does, and the number
+    of the chunk each row was bootstrapped in: the source rows
+    then one per shard
+    '''
+    import polars as pl
+    position = pl.col('_position').cast(pl.Int64)
+    return lf.with_row_index('_position').with_columns(
+        pl.col('country').replace_strict(country_codes().mapping, default='XX', return_dtype=pl.Utf8)
+          .fill_null('XX').alias('country_code'),
+        pl.col('region').replace_strict(salespeople().mapping, default='Unknown', return_dtype=pl.Utf8)
+          .fill_null('Unknown').alias('salesperson'),
+        pl.when(position < source_rows).then(0)
+          .otherwise((position - source_rows) // conf_boot['shard_size'] + 1).alias('_chunk'))
+
+
+def normalize_regions(lf, cols: List[str]):
+    '''
+    One row per distinct region with the max of every other
+    column. Ids are dense in order of the chunk a region first
+    appears in, then of its keys, as chunks are folded in
+    '''
+    import polars as pl
+    others = [c for c in cols if c not in REGION_KEYS]
+    return lf.filter(pl.all_horizontal(pl.col(REGION_KEYS).is_not_null()))\
+        .group_by(REGION_KEYS)\
+        .agg(pl.col('_chunk').min(), *[pl.col(c).max() for c in others])\
+        .sort(['_chunk', *REGION_KEYS])\
+        .with_row_index('id')\
+        .select([pl.col('id').cast(pl.Int64), *REGION_KEYS, *others])
+
+
+def partition_keys() -> List:
+    '''
+    Year and region of a row, the region being null where its
+    region_id is, as partition_keys derives them
+    '''
+    import polars as pl
+    return [pl.col('order_date').dt.year().cast(pl.Int64).alias('order_year'),
+            pl.when(pl.all_horizontal(pl.col(REGION_KEYS).is_not_null()))
+              .then(pl.col('region')).alias('region')]
+
+
+def normalize_orders(lf, cols: List[str], regions, keys: List = ()):
+    import polars as pl
+    ids = regions.select([pl.col('id').alias('region_id'), *REGION_KEYS])
+    return lf.join(ids, on=REGION_KEYS, how='left', maintain_order='left')\
+        .select(['id', *[c for c in cols if c != 'id'], 'region_id', *keys])
+
+
+def normalize_returns(lf, cols: List[str], keys: List = ()):
+    '''
+    Last row per order id within each chunk, of the orders
+    with a returned quantity
+    '''
+    import polars as pl
+    return lf.filter(pl.col('order_id').is_not_null())\
+        .unique(subset=['_chunk', 'order_id'], keep='last', maintain_order=True)\
+        .filter(pl.col('return_quantity') > 0)\
+        .sort(['_chunk', 'order_id'], maintain_order=True)\
+        .select(['order_id', *[c for c in cols if c != 'order_id'], *keys])
+
+
+def rollup(lf, by: List[str]):
+    '''
+    Sums and averages of the order rows by the columns by, as
+    order_facts and rollup derive them; a row is returned if
+    its order id is among its chunk's returns
+    '''
+    import polars as pl
+    returned = lf.filter(pl.col('order_id').is_not_null())\
+        .unique(subset=['_chunk', 'order_id'], keep='last')\
+        .filter(pl.col('return_quantity') > 0)\
+        .select('_chunk', 'order_id', pl.lit(1, pl.Int64).alias('returned_lines'))
+    facts = lf.join(returned, on=['_chunk', 'order_id'], how='left').select(
+        pl.col('order_date').dt.truncate('1mo').cast(pl.Date).alias('month'),
+        partition_keys()[1],
+        'sub_category',
+        'segment',
+        pl.lit(1, pl.Int64).alias('order_lines'),
+        pl.col('returned_lines').fill_null(0),
+        'sales',
+        'profit',
+        pl.col('discount').alias('discount_sum'))
+    return facts.group_by(by).agg(pl.col(ROLLUP_SUMS).sum())\
+        .with_columns(pl.col('sales', 'profit', 'discount_sum').round(ROLLUP_DECIMALS))\
+        .with_columns((pl.col('discount_sum') / pl.col('order_lines')).alias('discount'),
+                      (pl.col('returned_lines') / pl.col('order_lines')).alias('return_rate'))\
+        .sort(by, nulls_last=True)
+
+
+def last_by_key(lf, cols: List[str], key: str):
+    '''
+    Keeps the last row for each non-null key, sorted by key
+    '''
+    import polars as pl
+    return lf.filter(pl.col(key).is_not_null())\
+        .unique(subset=[key], keep='last', maintain_order=True)\
+        .sort(key)\
+        .select([key, *[c for c in cols if c != key]])
+
+
+def sink(lf, name: str, conf_out: Dict[str, Any], csv_options: Dict[str, str],
+         partition_by: List[str] = None):
+    '''
+    Streams a table to disk in the layout TableWriter uses, or
+    PartitionedWriter if partitioned by partition_by
+    '''
+    import polars as pl
+    fmt = conf_out['format']
+    path = table_path(DIR_OUTPUT, name, fmt)
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.remove(path)
+    if fmt == 'parquet':
+        # dictionary encoded, as pandas writes categoricals, and
+        # dates as the timestamps pandas parses them to
+        names = lf.collect_schema().names()
+        lf = lf.with_columns(pl.col(pl.Date).cast(pl.Datetime('us')),
+                             *[pl.col(c).cast(pl.Categorical) for c in CATEGORICAL if c in names])
+    if not partition_by:
+        pl.collect_all([sink_part(lf, path, conf_out, csv_options)])
+        return
+    # the table is built once, into a scratch file each partition's
+    # query then filters, rather than once per partition
+    os.makedirs(path)
+    scratch = os.path.join(path, '_scratch.parquet')
+    lf.sink_parquet(scratch, compression='uncompressed')
+    lf = pl.scan_parquet(scratch)
+    partitions = partition_stats(lf, partition_by)
+    pl.collect_all([
+        sink_part(lf.filter(pl.all_horizontal([pl.col(c).eq_missing(v) for c, v in zip(partition_by, key)]))
+                    .drop(partition_by),
+                  part_path(os.path.join(path, partition_path(partition_by, key)), fmt),
+                  conf_out, csv_options)
+        for key in partitions])
+    os.remove(scratch)
+    write_manifest(path, fmt, partition_by, partitions)
+
+
+def sink_part(lf, path: str, conf_out: Dict[str, Any], csv_options: Dict[str, str]):
+    '''
+    Query writing lf to a csv file or a parquet directory at
+    path, run once collected
+    '''
+    if conf_out['format'] == 'csv':
+        # float_format '%.2f' is a precision of 2
+        precision = csv_options.get('float_format')
+        return lf.sink_csv(path, float_precision=int(precision[2:-1]) if precision else None,
+                           mkdir=True, lazy=True)
+    return lf.sink_parquet(os.path.join(path, 'part-00000.parquet'),
+                           compression=conf_out['compression'],
+                           row_group_size=conf_out['row_group_size'],
+                           mkdir=True, lazy=True)
+
+
+def partition_stats(lf, partition_by: List[str]) -> Dict[tuple, Dict[str, Any]]:
+    '''
+    Rows, and min and max of the numeric and date columns, of
+    each partition, as stats gives them
+    '''
+    import polars as pl
+    schema = lf.collect_schema()
+    cols = [c for c, t in schema.items()
+            if c not in partition_by and (t.is_numeric() or t.is_temporal())]
+
+    def col(c):
+        return pl.col(c).cast(pl.Datetime('us')) if schema[c] == pl.Date else pl.col(c)
+    found = lf.group_by(partition_by).agg(
+        pl.len().alias('_rows'),
+        *[col(c).min().alias(f'_min_{c}') for c in cols],
+        *[col(c).max().alias(f'_max_{c}') for c in cols]).collect()
+    return {tuple(jsonable(r[c]) for c in partition_by): {
+                'rows': r['_rows'],
+                'min': {c: jsonable(r[f'_min_{c}']) for c in cols},
+                'max': {c: jsonable(r[f'_max_{c}']) for c in cols}}
+            for r in found.iter_rows(named=True)}
@@ -1,170 +1,174 @@
-import os
+import re
 import sys
 import logging
 import pandas as pd
 import numpy as np
-import json
-from scipy.stats import expon
 from typing import Dict, NewType, Any
-from config.config import DIR_DATA, DIR_CONFIG
+from util.helper import timer
+from util.reference import country_codes, salespeople, discounts
+from util.rng import stream
 
 DataFrame = NewType('DataFrame', pd.DataFrame)
 Series = NewType('Series', pd.Series)
 
+# y1_mapping is the target year of FIRST_SOURCE_YEAR
+YEAR_MAPPING_KEY = re.compile(r'y(\d+)_mapping')
+FIRST_SOURCE_YEAR = 2011
+
 ##########
 # Products
 ##########
 
+@timer
 def get_product_cost_to_consumer(df: DataFrame) -> Series:
     logging.debug(f'Transforming {df.shape[0]} records in {sys._getframe(  ).f_code.co_name}...')
-    res: List[float] = []
-    for i, r in df.iterrows():
-        res.append(round(r['sales'] / r['quantity'], 2))
-    return pd.Series(data=res, name='product_cost_to_consumer')
+    return (df['sales'] / df['quantity']).round(2).rename('product_cost_to_consumer')
 
 #########
 # Regions
 #########
 
+@timer
 def get_country_code(df: DataFrame) -> Series:
     logging.debug(f'Transforming {df.shape[0]} records in {sys._getframe(  ).f_code.co_name}...')
-    # thank you country.io, mods needed
-    # for myanmar and cote d'ivoire
-    with open(os.path.join(DIR_CONFIG, './country_codes.json')) as f:
-        cc_lookup: Dict[str, str] = json.loads(f.read())
-    cc_rev_lookup: Dict[str, str] = {}
-    for k, v in cc_lookup.items():
-        cc_rev_lookup[v] = k
-    return df.copy()['country'].apply(lambda x: cc_rev_lookup.get(x) or 'XX')
+    return country_codes()(df['country']).rename('country_code')
 
+@timer
 def get_salesperson(df: DataFrame) -> Series:
     logging.debug(f'Transforming {df.shape[0]} records in {sys._getframe(  ).f_code.co_name}...')
-    with open(os.path.join(DIR_CONFIG, 'regions.json')) as f:
-        sp_lookup: Dict[str, str] = json.loads(f.read())
-    return df.copy()['region'].apply(lambda x: sp_lookup.get(x) or 'Unknown')
+    return salespeople()(df['region']).rename('salesperson')
 
 #########
 # Returns
 #########
 
-def get_return_date(df: DataFrame, conf: Dict[Any, Any]) -> Series:
+@timer
+def get_return_date(df: DataFrame, conf: Dict[Any, Any], rng: np.random.Generator = None) -> Series:
+    '''
+    Return dates are a whole number of days after the order date,
+    uniform on [return_date_low, return_date_high) but truncated so
+    they never fall before the ship date. Rows which ship after the
+    last possible return day are returned on the ship date
+    '''
     # logging.debug(f'Transforming {df.shape[0]} records in {sys._getframe(  ).f_code.co_name}...')
-    ship_date = df['ship_date']
-    order_date = df['order_date']
-    rd = []
-    for sd, od in zip(ship_date, order_date):
-        sd = pd.to_datetime(sd, format="%Y-%m-%d")
-        od = pd.to_datetime(od, format="%Y-%m-%d")
-        return_date = calculate_return_date(od, conf)
-        while return_date < sd:
-            return_date = calculate_return_date(od, conf)
-        rd.append(return_date)
-    return pd.Series(rd)
-
-def calculate_return_date(timestamp, conf):
-    return timestamp + \
-        pd.Timedelta(np.random.randint(low=conf['return_date_low'],
-                                       high=conf['return_date_high'],
-                                       size=1)[0], unit='D')
-
-def get_expon(n: int, s: int = 10) -> int:
-    v: int = int(round(expon.rvs(loc=0, scale=n/s)))
-    return v if v <= n else v
-
+    rng = rng or stream('transform.return_date')
+    od = pd.to_datetime(df['order_date'], format="%Y-%m-%d").values.astype('datetime64[D]')
+    sd = pd.to_datetime(df['ship_date'], format="%Y-%m-%d").values.astype('datetime64[D]')
+    low = np.maximum(conf['return_date_low'], (sd - od).astype('int64'))
+    high = conf['return_date_high']
+    offset = np.where(low < high, rng.integers(np.minimum(low, high - 1), high), low)
+    return pd.Series(od + offset.astype('timedelta64[D]'), index=df.index, name='return_date')
+
+def get_expon(n: np.ndarray, s: int = 10, rng: np.random.Generator = None) -> np.ndarray:
+    '''
+    One exponential draw per element of n, each scaled by n/s
+    '''
+    rng = rng or stream('transform.expon')
+    n = np.asarray(n)
+    return np.round(rng.exponential(scale=n/s, size=n.shape)).astype('int64')
+
+@timer
 def get_return_quantity(df: DataFrame) -> Series:
     logging.debug(f'Transforming {df.shape[0]} records in {sys._getframe(  ).f_code.co_name}...')
-    res: List[float] = []
-    for i, r in df.iterrows():
-        # modify the rate of return by s parameter
-        # higher s parameter is lower rate of return
-        # 24.65 is about a 5% rate of return, 50k out of 1M
-        res.append(get_expon(r['quantity'], s=24.655))
-    return pd.Series(data=res, name='return_quantity')
-
+    # modify the rate of return by s parameter
+    # higher s parameter is lower rate of return
+    # 24.65 is about a 5% rate of return, 50k out of 1M
+    return pd.Series(data=get_expon(df['quantity'].values, s=24.655,
+                                    rng=stream('transform.return_quantity')),
+                     index=df.index,
+                     name='return_quantity')
+
+@timer
 def get_reason_returned(df: DataFrame) -> Series:
     logging.debug(f'Transforming {df.shape[0]} records in {sys._getframe(  ).f_code.co_name}...')
-    res: List[str] = []
-    for i, r in df.iterrows():
-        res.append(
-            np.random.choice(
-                ['Wrong Color',
-                 'Not Given',
-                 'Wrong Item',
-                 'Not Needed'],
-                replace=True,
-                p = [0.15, 0.4, 0.3, 0.15]
-            )
-        )
-    return pd.Series(data=res, name='reason_returned')
+    reasons = ['Wrong Color', 'Not Given', 'Wrong Item', 'Not Needed']
+    res = stream('transform.reason_returned').choice(
+        len(reasons),
+        size=df.shape[0],
+        replace=True,
+        p = [0.15, 0.4, 0.3, 0.15]
+    )
+    return pd.Series(data=pd.Categorical.from_codes(res, reasons), index=df.index, name='reason_returned')
 
 ########
 # Orders
 ########
 
+@timer
 def get_discount(df: DataFrame) -> Series:
     logging.debug(f'Transforming {df.shape[0]} records in {sys._getframe(  ).f_code.co_name}...')
-    with open(os.path.join(DIR_CONFIG, './discounts.json')) as f:
-        discount_lookup: Dict[str, float] = json.loads(f.read())
-    res: List[float] = []
-    for i, r in df.iterrows():
-        res.append(
-            discount_lookup['sub_category'][r['sub_category']] +\
-            discount_lookup['region'][r['region']]
-        )
-    return pd.Series(data=res, name='discount')
+    return (discounts('sub_category')(df['sub_category']) +\
+            discounts('region')(df['region'])).rename('discount')
 
+@timer
 def get_shifted_order_id(df: DataFrame, conf: Dict[Any, Any]) -> Series:
     logging.debug(f'Transforming {df.shape[0]} records in {sys._getframe(  ).f_code.co_name}...')
-    y1 = df['order_id'].apply(lambda x: x.replace('-2011-', '-' + conf['y1_mapping'] + '-'))
-    y2 = y1.apply(lambda x: x.replace('-2012-', '-' + conf['y2_mapping'] + '-'))
-    y3 = y2.apply(lambda x: x.replace('-2013-', '-' + conf['y3_mapping'] + '-'))
-    y4 = y3.apply(lambda x: x.replace('-2014-', '-' + conf['y4_mapping'] + '-'))
-    y5 = y4.apply(lambda x: x.replace('-2015-', '-' + conf['y5_mapping'] + '-'))
-    return y5
+    return YearMapping(conf).shift_ids(df['order_id'])
 
+@timer
 def get_shifted_order_date(df: DataFrame, conf: Dict[Any, Any]) -> Series:
     logging.debug(f'Transforming {df.shape[0]} records in {sys._getframe(  ).f_code.co_name}...')
+    return YearMapping(conf).shift_dates(df['order_date'])
 
-    leap_year_clean = df['order_date'].apply(lambda x: x.replace('-02-29', '-02-28'))
-    y1 = leap_year_clean.apply(lambda x: x.replace('2011', conf['y1_mapping']))
-    y2 = y1.apply(lambda x: x.replace('2012', conf['y2_mapping']))
-    y3 = y2.apply(lambda x: x.replace('2013', conf['y3_mapping']))
-    y4 = y3.apply(lambda x: x.replace('2014', conf['y4_mapping']))
-    y5 = y4.apply(lambda x: x.replace('2015', conf['y5_mapping']))
-    return pd.to_datetime(y5, format="%Y-%m-%d")
-
+@timer
 def get_shifted_ship_date(df: DataFrame, conf: Dict[Any, Any]) -> Series:
     logging.debug(f'Transforming {df.shape[0]} records in {sys._getframe(  ).f_code.co_name}...')
-    leap_year_clean = df['ship_date'].apply(lambda x: x.replace('-02-29', '-02-28'))
-    y1 = leap_year_clean.apply(lambda x: x.replace('2011', conf['y1_mapping']))
-    y2 = y1.apply(lambda x: x.replace('2012', conf['y2_mapping']))
-    y3 = y2.apply(lambda x: x.replace('2013', conf['y3_mapping']))
-    y4 = y3.apply(lambda x: x.replace('2014', conf['y4_mapping']))
-    y5 = y4.apply(lambda x: x.replace('2015', conf['y5_mapping']))
-    return pd.to_datetime(y5, format="%Y-%m-%d")
+    return YearMapping(conf).shift_dates(df['ship_date'])
 
+@timer
 def get_shifted_return_date(df: DataFrame, conf: Dict[Any, Any]) -> Series:
     logging.debug(f'Transforming {df.shape[0]} records in {sys._getframe(  ).f_code.co_name}...')
-    y1 = df['return_date'].apply(lambda x: x.replace('2011', conf['y1_mapping']))
-    y2 = y1.apply(lambda x: x.replace('2012', conf['y2_mapping']))
-    y3 = y2.apply(lambda x: x.replace('2013', conf['y3_mapping']))
-    y4 = y3.apply(lambda x: x.replace('2014', conf['y4_mapping']))
-    y5 = y4.apply(lambda x: x.replace('2015', conf['y5_mapping']))
-    return y5
+    return YearMapping(conf).shift_dates(df['return_date'])
 
+@timer
 def get_shifted_date_rank(df: DataFrame, conf: Dict[Any, Any]) -> Series:
     logging.debug(f'Transforming {df.shape[0]} records in {sys._getframe(  ).f_code.co_name}...')
-    y1 = df['date_rank'].apply(lambda x: x.replace('2011', conf['y1_mapping']))
-    y2 = y1.apply(lambda x: x.replace('2012', conf['y2_mapping']))
-    y3 = y2.apply(lambda x: x.replace('2013', conf['y3_mapping']))
-    y4 = y3.apply(lambda x: x.replace('2014', conf['y4_mapping']))
-    y5 = y4.apply(lambda x: x.replace('2015', conf['y5_mapping']))
-    return y5
+    return YearMapping(conf).shift_dates(df['date_rank'])
+
+class YearMapping:
+    '''
+    Source to target year lookup compiled from the y<n>_mapping
+    entries of the transform config, where y1 maps 2011, y2 maps
+    2012 and so on. Any number of mapped years is supported.
+    '''
+
+    def __init__(self, conf: Dict[Any, Any]):
+        self.years: Dict[int, int] = {}
+        for k, v in conf.items():
+            m = YEAR_MAPPING_KEY.fullmatch(k)
+            if m:
+                self.years[FIRST_SOURCE_YEAR + int(m.group(1)) - 1] = int(v)
+        self._id_pattern = re.compile('-(' + '|'.join(map(str, self.years)) + ')-')
+
+    def shift_ids(self, s: Series) -> Series:
+        '''
+        Replaces the -YYYY- year segment of ids in a single pass
+        '''
+        return s.str.replace(self._id_pattern,
+                             lambda m: f'-{self.years[int(m.group(1))]}-',
+                             regex=True)
+
+    def shift_dates(self, s: Series) -> Series:
+        '''
+        Moves dates to their target year, keeping month, day and
+        time of day. Feb 29 is clamped to Feb 28 so every date
+        exists in its target year
+        '''
+        dates = pd.to_datetime(s, format="%Y-%m-%d")
+        day = dates.dt.day.where(~((dates.dt.month == 2) & (dates.dt.day == 29)), 28)
+        year = dates.dt.year.map(self.years).fillna(dates.dt.year)
+        shifted = pd.to_datetime(pd.DataFrame({
+            'year': year,
+            'month': dates.dt.month,
+            'day': day
+        }))
+        return (shifted + (dates - dates.dt.normalize())).rename(s.name)
 
 ###########
 # Customers
 ###########
 
+@timer
 def get_postal_code(df: DataFrame) -> Series:
     logging.debug(f'Transforming {df.shape[0]} records in {sys._getframe(  ).f_code.co_name}...')
     return df['postal_code'].astype('object')
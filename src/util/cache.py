@@ -0,0 +1,115 @@
+import os
+import json
+import hashlib
+import logging
+import pandas as pd
+from typing import Any, Callable, Dict, NewType, Optional, Tuple
+
+DataFrame = NewType('DataFrame', pd.DataFrame)
+
+# bump when the shape of cached entries changes
+CACHE_VERSION = 1
+FORMATS = {'feather', 'parquet'}
+
+
+def file_hash(path: str) -> str:
+    '''
+    sha256 of a file's content
+    '''
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def cache_key(*parts: Any) -> str:
+    '''
+    Key for an entry derived from any JSON-serializable parts,
+    e.g. file hashes and the options the entry was built with
+    '''
+    return hashlib.sha256(
+        json.dumps([CACHE_VERSION, *parts], sort_keys=True, default=str).encode()
+    ).hexdigest()
+
+
+def cached(directory: str, key: str, build: Callable[[], Tuple[Optional[DataFrame], Dict[str, Any]]],
+           fmt: str = 'feather', max_bytes: int = None) -> Tuple[Optional[DataFrame], Dict[str, Any]]:
+    '''
+    Returns the (frame, metadata) entry stored under key, calling
+    build and storing its result first if there is none. Either
+    part may be used alone; metadata is kept in a JSON sidecar
+    '''
+    if fmt not in FORMATS:
+        raise ValueError(f'Unknown cache format {fmt!r}, expected one of {sorted(FORMATS)}')
+    meta_path = os.path.join(directory, f'{key}.json')
+    data_path = os.path.join(directory, f'{key}.{fmt}')
+    if os.path.exists(meta_path):
+        with open(meta_path) as f:
+            entry = json.loads(f.read())
+        if not entry['has_frame'] or os.path.exists(data_path):
+            logging.debug(f'Cache hit for {key[:12]}')
+            df = _read(data_path, fmt) if entry['has_frame'] else None
+            # touch entries on use for least recently used eviction
+            for p in (meta_path, data_path):
+                if os.path.exists(p):
+                    os.utime(p)
+            return df, entry['meta']
+
+    logging.debug(f'Cache miss for {key[:12]}')
+    df, meta = build()
+    os.makedirs(directory, exist_ok=True)
+    if df is not None:
+        _write(df, data_path, fmt)
+    with open(meta_path, 'w') as f:
+        f.write(json.dumps({'has_frame': df is not None, 'meta': meta}))
+    if max_bytes is not None:
+        evict(directory, max_bytes, keep=key)
+    return df, meta
+
+
+def invalidate(directory: str, key: str = None):
+    '''
+    Removes the entry stored under key, or every entry
+    '''
+    if not os.path.isdir(directory):
+        return
+    for f in os.listdir(directory):
+        if key is None or f.split('.')[0] == key:
+            os.unlink(os.path.join(directory, f))
+    logging.debug(f'Invalidated cache {key or "entries"} in {directory}')
+
+
+def evict(directory: str, max_bytes: int, keep: str = None):
+    '''
+    Removes least recently used entries, other than keep, until
+    the cache directory holds at most max_bytes
+    '''
+    entries: Dict[str, list] = {}
+    for f in os.listdir(directory):
+        path = os.path.join(directory, f)
+        entries.setdefault(f.split('.')[0], []).append(
+            (os.path.getmtime(path), os.path.getsize(path), path))
+    total = sum(size for files in entries.values() for _, size, _ in files)
+    for key, files in sorted(entries.items(), key=lambda kv: max(m for m, _, _ in kv[1])):
+        if total <= max_bytes:
+            break
+        if key == keep:
+            continue
+        for _, size, path in files:
+            os.unlink(path)
+            total -= size
+        logging.debug(f'Evicted cache entry {key[:12]}')
+
+
+def _read(path: str, fmt: str) -> DataFrame:
+    if fmt == 'feather':
+        return pd.read_feather(path)
+    return pd.read_parquet(path)
+
+
+def _write(df: DataFrame, path: str, fmt: str):
+    if fmt == 'feather':
+        df.reset_index(drop=True).to_feather(path)
+    else:
+        df.to_parquet(path)
@@ -3,7 +3,9 @@ import logging
 import functools
 import time
 import pandas as pd
-from typing import Dict, NewType
+from collections import deque
+from util import metrics
+from typing import Callable, Dict, Iterable, Iterator, NewType
 
 DataFrame = NewType('DataFrame', pd.DataFrame)
 Series = NewType('Series', pd.Series)
@@ -14,13 +16,46 @@ def get_postal_code(df: DataFrame) -> Series:
     return df['postal_code'].astype('object')
 
 def timer(func):
-    """Print the runtime of the decorated function"""
+    """Print the runtime of the decorated function, and record it
+    in the run metrics along with its CPU time, peak memory growth
+    and the rows it was given"""
+    module = 'main' if func.__module__ == '__main__' else func.__module__
     @functools.wraps(func)
     def wrapper_timer(*args, **kwargs):
         start_time = time.perf_counter()
-        value = func(*args, **kwargs)
+        with metrics.measure(f'{module}.{func.__qualname__}') as m:
+            value = func(*args, **kwargs)
+            m['rows'] = metrics.rows_of(args, value)
         end_time = time.perf_counter()
         run_time = end_time - start_time
         logging.debug(f'Finished {func.__name__!r} in {run_time:.4f} secs')
         return value
     return wrapper_timer
+
+def imap_bounded(executor, fn: Callable, tasks: Iterable, window: int) -> Iterator:
+    """Map fn over tasks on executor, yielding results in task order
+    with at most window tasks submitted ahead of the consumer"""
+    pending = deque()
+    for task in tasks:
+        pending.append(executor.submit(fn, task))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+def rechunk(chunks: Iterable[DataFrame], sizes: Iterator[int]) -> Iterator[DataFrame]:
+    """Regroup a stream of DataFrames into chunks of the given
+    sizes; the last chunk holds whatever rows remain"""
+    buffer, buffered = [], 0
+    size = next(sizes)
+    for chunk in chunks:
+        buffer.append(chunk)
+        buffered += chunk.shape[0]
+        while buffered >= size:
+            df = pd.concat(buffer)
+            yield df.iloc[:size]
+            buffer = [df.iloc[size:]]
+            buffered -= size
+            size = next(sizes)
+    if buffered:
+        yield pd.concat(buffer)
@@ -0,0 +1,130 @@
+import sys
+import json
+import time
+import resource
+import threading
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List
+
+'''
+Run metrics. Timed sections are aggregated by name into wall
+time, CPU time of the calling thread, rows handled and the growth
+of the process' peak resident memory. Sections given labels also
+keep one sample per call. Times are inclusive of nested sections.
+Worker processes keep their own metrics, which are drained and
+merged into the parent's.
+'''
+
+_lock = threading.Lock()
+_totals: Dict[str, Dict[str, float]] = {}
+_samples: Dict[str, List[Dict[str, Any]]] = {}
+
+
+def peak_rss(who: int = resource.RUSAGE_SELF) -> float:
+    '''
+    Peak resident memory of this process so far, or of its
+    largest finished child with RUSAGE_CHILDREN, in MB
+    '''
+    peak = resource.getrusage(who).ru_maxrss
+    # bytes on macOS, kilobytes elsewhere
+    return peak / 2**20 if sys.platform == 'darwin' else peak / 2**10
+
+
+@contextmanager
+def measure(name: str, **labels: Any) -> Iterator[Dict[str, Any]]:
+    '''
+    Times the enclosed block under name. Set 'rows' on the
+    yielded dict to record the number of rows it handled
+    '''
+    m: Dict[str, Any] = {'rows': None}
+    peak, cpu, start = peak_rss(), time.thread_time(), time.perf_counter()
+    yield m
+    wall = time.perf_counter() - start
+    record(name, wall, time.thread_time() - cpu, m['rows'], peak_rss() - peak, labels)
+
+
+def record(name: str, wall: float, cpu: float, rows: int = None, peak_delta: float = 0.0,
+           labels: Dict[str, Any] = None):
+    with _lock:
+        t = _totals.setdefault(name, {'calls': 0, 'wall_secs': 0.0, 'cpu_secs': 0.0,
+                                      'rows': 0, 'peak_rss_delta_mb': 0.0})
+        t['calls'] += 1
+        t['wall_secs'] += wall
+        t['cpu_secs'] += cpu
+        t['rows'] += rows or 0
+        t['peak_rss_delta_mb'] = max(t['peak_rss_delta_mb'], peak_delta)
+        if labels:
+            _samples.setdefault(name, []).append({
+                **labels,
+                'rows': rows,
+                'wall_secs': wall,
+                'cpu_secs': cpu,
+                'rows_per_sec': rows / wall if rows and wall else None,
+                'peak_rss_delta_mb': peak_delta
+            })
+
+
+def rows_of(args: tuple, value: Any = None) -> int:
+    '''
+    Rows of the first DataFrame or Series argument, or of the
+    value returned if there is none
+    '''
+    for a in (*args, value):
+        if hasattr(a, 'shape') and hasattr(a, 'index'):
+            return a.shape[0]
+    return None
+
+
+def drain() -> Dict[str, Any]:
+    '''
+    Returns and clears this process' metrics
+    '''
+    with _lock:
+        out = {'totals': dict(_totals), 'samples': dict(_samples)}
+        _totals.clear()
+        _samples.clear()
+    return out
+
+
+def merge(metrics: Dict[str, Any]):
+    '''
+    Adds metrics drained from another process
+    '''
+    with _lock:
+        for name, t in metrics['totals'].items():
+            mine = _totals.setdefault(name, {'calls': 0, 'wall_secs': 0.0, 'cpu_secs': 0.0,
+                                             'rows': 0, 'peak_rss_delta_mb': 0.0})
+            for k in ('calls', 'wall_secs', 'cpu_secs', 'rows'):
+                mine[k] += t[k]
+            mine['peak_rss_delta_mb'] = max(mine['peak_rss_delta_mb'], t['peak_rss_delta_mb'])
+        for name, samples in metrics['samples'].items():
+            _samples.setdefault(name, []).extend(samples)
+
+
+def report(**run: Any) -> Dict[str, Any]:
+    '''
+    Metrics gathered so far, with throughput per section, plus
+    any run level fields given
+    '''
+    with _lock:
+        sections = {}
+        for name, t in sorted(_totals.items()):
+            sections[name] = {**t, 'rows_per_sec': t['rows'] / t['wall_secs']
+                              if t['rows'] and t['wall_secs'] else None}
+        samples = {k: list(v) for k, v in _samples.items()}
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return {
+        **run,
+        'cpu_secs': usage.ru_utime + usage.ru_stime,
+        'worker_cpu_secs': children.ru_utime + children.ru_stime,
+        'peak_rss_mb': peak_rss(),
+        'worker_peak_rss_mb': peak_rss(resource.RUSAGE_CHILDREN),
+        'sections': sections,
+        'samples': samples
+    }
+
+
+def write_report(path: str, **run: Any):
+    with open(path, 'w') as f:
+        f.write(json.dumps(report(**run), indent=2, default=str))
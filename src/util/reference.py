@@ -0,0 +1,127 @@
+import os
+import json
+import threading
+import numpy as np
+import pandas as pd
+from typing import Any, Dict, NewType, Tuple
+from config.config import DIR_CONFIG
+
+Series = NewType('Series', pd.Series)
+
+'''
+Reference data from src/config. Each file is parsed once per
+process, on first use, into lookups that map a column through an
+array built once per set of categories, so mapping a chunk is a
+single take over its category codes. Worker processes forked
+after a lookup was built share it as is; it is never modified
+once built, other than adding tables for unseen categories.
+'''
+
+_lock = threading.Lock()
+_lookups: Dict[Tuple[str, str, bool, bool], 'Lookup'] = {}
+
+
+class Lookup:
+    '''
+    Maps keys to values and null keys to default. A missing key
+    raises a KeyError if strict, and maps to default otherwise
+    '''
+
+    def __init__(self, mapping: Dict[Any, Any], default: Any = None, strict: bool = True,
+                 source: str = 'lookup'):
+        self.mapping = mapping
+        self.default = default
+        self.strict = strict
+        self.source = source
+        self.numeric = all(isinstance(v, (int, float)) for v in mapping.values())
+        if not self.numeric:
+            self.values = pd.Index(sorted({*mapping.values(), default} - {None}))
+        self._tables: Dict[Tuple, np.ndarray] = {}
+
+    def table(self, categories: pd.Index) -> np.ndarray:
+        '''
+        The value of each category, as a code into values for
+        text values, followed by that of a null key
+        '''
+        key = tuple(categories)
+        table = self._tables.get(key)
+        if table is None:
+            looked_up = [self.mapping.get(c, self.default) for c in categories] + [self.default]
+            if self.numeric:
+                table = np.array([np.nan if v is None else v for v in looked_up], dtype='float64')
+            else:
+                table = self.values.get_indexer(looked_up).astype('int32')
+            self._tables[key] = table
+        return table
+
+    def __call__(self, s: Series) -> Series:
+        if not isinstance(s.dtype, pd.CategoricalDtype):
+            s = s.astype('category')
+        # null keys have code -1, which takes the last entry
+        codes = s.cat.codes.to_numpy()
+        if self.strict:
+            # only the categories present count, as unused ones may linger
+            present = s.cat.categories[np.unique(codes[codes >= 0])]
+            missing = [c for c in present if c not in self.mapping]
+            if missing:
+                raise KeyError(f'No {self.source} entry for {sorted(missing)}')
+        taken = self.table(s.cat.categories).take(codes)
+        if not self.numeric:
+            taken = pd.Categorical.from_codes(taken, categories=self.values)
+        return pd.Series(taken, index=s.index)
+
+
+def lookup(name: str, key: str = None, default: Any = None, invert: bool = False,
+           strict: bool = True) -> Lookup:
+    '''
+    Lookup of the config file name, or of its key section;
+    invert maps the file's values back to its keys
+    '''
+    cache_key = (name, key, invert, strict)
+    found = _lookups.get(cache_key)
+    if found is None:
+        with _lock:
+            found = _lookups.get(cache_key)
+            if found is None:
+                with open(os.path.join(DIR_CONFIG, name)) as f:
+                    mapping = json.loads(f.read())
+                if key is not None:
+                    mapping = mapping[key]
+                if invert:
+                    mapping = {v: k for k, v in mapping.items()}
+                source = name if key is None else f'{name} {key}'
+                found = _lookups[cache_key] = Lookup(mapping, default, strict, source)
+    return found
+
+
+def country_codes() -> Lookup:
+    '''
+    Country name to ISO code; thank you country.io, mods
+    needed for myanmar and cote d'ivoire
+    '''
+    return lookup('country_codes.json', default='XX', invert=True, strict=False)
+
+
+def salespeople() -> Lookup:
+    '''
+    Region to its sales rep
+    '''
+    return lookup('regions.json', default='Unknown', strict=False)
+
+
+def discounts(column: str) -> Lookup:
+    '''
+    Discount by sub_category or by region; every one must be
+    configured
+    '''
+    return lookup('discounts.json', column)
+
+
+def _after_fork():
+    # a lock held by another thread at fork time is never
+    # released in the child, so it gets a fresh one
+    global _lock
+    _lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_after_fork)
@@ -0,0 +1,59 @@
+import hashlib
+import logging
+import numpy as np
+
+'''
+Seeded random streams. Every stream is a named child of a master
+seed, and a shard's stream a numbered child of its stage's, so a
+given seed makes the same draws however the work is split across
+processes, shards or runs. Draw from a stream in bulk, through
+the vectorized methods of the numpy Generator it returns.
+'''
+
+_master: int = None
+
+
+def set_seed(value: int = None):
+    '''
+    Sets this process' master seed; without one, fresh entropy
+    is drawn, and logged so that the run can be repeated
+    '''
+    global _master
+    _master = np.random.SeedSequence(value).entropy
+    if value is None:
+        logging.info(f'No seed configured, drew master seed {_master}')
+
+
+def master_seed(override: int = None) -> int:
+    '''
+    override if given, else this process' master seed
+    '''
+    if override is not None:
+        return override
+    if _master is None:
+        set_seed()
+    return _master
+
+
+def key(name: str) -> int:
+    '''
+    Spawn key of a stream name; unlike hash() it is the same
+    in every process
+    '''
+    return int.from_bytes(hashlib.sha256(name.encode()).digest()[:4], 'little')
+
+
+def sequence(name: str, *shard: int, seed: int = None) -> np.random.SeedSequence:
+    '''
+    Seed sequence of the stream name, or of one of its shards,
+    under seed or the master seed; picklable, so it can be
+    handed to worker processes
+    '''
+    return np.random.SeedSequence(master_seed(seed), spawn_key=(key(name), *shard))
+
+
+def stream(name: str, *shard: int, seed: int = None) -> np.random.Generator:
+    '''
+    Generator of the stream name, or of one of its shards
+    '''
+    return np.random.default_rng(sequence(name, *shard, seed=seed))
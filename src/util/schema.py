@@ -0,0 +1,57 @@
+import numpy as np
+import pandas as pd
+from typing import Dict, List, NewType
+
+DataFrame = NewType('DataFrame', pd.DataFrame)
+Series = NewType('Series', pd.Series)
+
+# low cardinality text columns, held as categoricals
+CATEGORICAL: List[str] = [
+    'region',
+    'country',
+    'country_code',
+    'state',
+    'city',
+    'market',
+    'segment',
+    'category',
+    'sub_category',
+    'ship_mode',
+    'order_priority',
+    'salesperson',
+    'reason_returned'
+]
+
+# numeric columns and the narrowest dtype holding their values
+NUMERIC: Dict[str, str] = {
+    'row_id': 'int32',
+    'quantity': 'int16',
+    'return_quantity': 'int16',
+    'index_rank': 'int32',
+    'postal_code': 'float32'
+}
+
+
+def compact(df: DataFrame) -> DataFrame:
+    '''
+    Casts the columns of df listed above to their compact
+    dtypes in place; columns already cast are left as is
+    '''
+    for col in df.columns.intersection(CATEGORICAL):
+        if not isinstance(df[col].dtype, pd.CategoricalDtype):
+            df[col] = df[col].astype('category')
+    for col in df.columns.intersection(list(NUMERIC)):
+        if df[col].dtype != NUMERIC[col]:
+            df[col] = downcast(df[col], NUMERIC[col])
+    return df
+
+
+def downcast(s: Series, dtype: str) -> Series:
+    '''
+    Casts s to dtype, refusing integer values it cannot hold
+    '''
+    if np.issubdtype(np.dtype(dtype), np.integer) and s.size:
+        info = np.iinfo(dtype)
+        if s.min() < info.min or s.max() > info.max:
+            raise OverflowError(f'Values of {s.name} do not fit in {dtype}')
+    return s.astype(dtype)
@@ -0,0 +1,107 @@
+import numpy as np
+import pandas as pd
+from typing import Dict, List, NewType, Any
+
+Series = NewType('Series', pd.Series)
+
+'''
+Fixed size summaries of a column which are updated one chunk at
+a time and can be merged, so a column of any length is summarized
+in one pass and constant memory.
+'''
+
+
+class Counts:
+    '''
+    Occurrences of each distinct value; meant for columns with
+    few distinct values
+    '''
+
+    def __init__(self):
+        self.counts: Dict[Any, int] = {}
+        self.missing = 0
+
+    def update(self, s: Series):
+        self.missing += int(s.isnull().sum())
+        for k, v in s.value_counts(dropna=True).items():
+            self.counts[k] = self.counts.get(k, 0) + int(v)
+
+    def merge(self, other: 'Counts'):
+        self.missing += other.missing
+        for k, v in other.counts.items():
+            self.counts[k] = self.counts.get(k, 0) + v
+
+    @property
+    def total(self) -> int:
+        return sum(self.counts.values())
+
+    def frequencies(self, keys: List[Any]) -> np.ndarray:
+        return np.array([self.counts.get(k, 0) for k in keys], dtype='float64')
+
+
+class Histogram:
+    '''
+    Counts of values between fixed bin edges, plus the running
+    min and max. Values below the first edge or above the last
+    fall in open-ended bins at either end
+    '''
+
+    def __init__(self, edges: np.ndarray):
+        self.edges = np.asarray(edges, dtype='float64')
+        self.counts = np.zeros(self.edges.shape[0] + 1, dtype='int64')
+        self.missing = 0
+        self.min = np.inf
+        self.max = -np.inf
+
+    @classmethod
+    def from_quantiles(cls, s: Series, bins: int) -> 'Histogram':
+        '''
+        Histogram with edges at the quantiles of s, so each bin
+        holds about the same share of it
+        '''
+        values = s.dropna().to_numpy(dtype='float64')
+        edges = np.unique(np.quantile(values, np.linspace(0, 1, bins + 1))) if values.size else []
+        return cls(edges)
+
+    def update(self, s: Series):
+        values = s.to_numpy(dtype='float64', na_value=np.nan)
+        present = values[~np.isnan(values)]
+        self.missing += values.shape[0] - present.shape[0]
+        if present.size:
+            self.counts += np.bincount(np.searchsorted(self.edges, present, side='right'),
+                                       minlength=self.counts.shape[0])
+            self.min = min(self.min, present.min())
+            self.max = max(self.max, present.max())
+
+    def merge(self, other: 'Histogram'):
+        if not np.array_equal(self.edges, other.edges):
+            raise ValueError('Only histograms with the same bin edges can be merged')
+        self.counts += other.counts
+        self.missing += other.missing
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    @property
+    def total(self) -> int:
+        return int(self.counts.sum())
+
+    def cdf(self) -> np.ndarray:
+        '''
+        Share of values below each edge and in total
+        '''
+        return np.cumsum(self.counts) / max(self.total, 1)
+
+    def quantile(self, q: float) -> float:
+        '''
+        Interpolated within the bin holding the q-th value; the
+        open-ended bins are bounded by the min and max seen
+        '''
+        if not self.total:
+            return np.nan
+        bounds = np.concatenate([[self.min], np.clip(self.edges, self.min, self.max), [self.max]])
+        cum = np.concatenate([[0], np.cumsum(self.counts)])
+        target = q * self.total
+        i = min(int(np.searchsorted(cum, target, side='left')), self.counts.shape[0])
+        i = max(i, 1)
+        inside = (target - cum[i - 1]) / max(self.counts[i - 1], 1)
+        return float(bounds[i - 1] + (bounds[i] - bounds[i - 1]) * min(max(inside, 0), 1))
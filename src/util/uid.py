@@ -0,0 +1,71 @@
+import numpy as np
+from typing import Iterable
+
+FEISTEL_ROUNDS = 4
+
+
+class UidAllocator:
+    '''
+    Hands out unique ids from [min_id, max_id) that do not collide
+    with a set of existing ids.
+
+    The k-th id handed out is a fixed function of k: k is passed
+    through a keyed Feistel permutation of [0, size) and the result
+    is mapped to the k-th free id in the range. Allocation is
+    therefore constant time per id regardless of how full the range
+    is, no record of issued ids is kept, and disjoint ranges of k
+    (e.g. one per shard) can be allocated independently.
+    '''
+
+    def __init__(self, min_id: int, max_id: int, existing: Iterable[int] = (), key: int = 0):
+        self.min_id = int(min_id)
+        self.max_id = int(max_id)
+        taken = np.unique(np.fromiter(existing, dtype='int64'))
+        taken = taken[(taken >= self.min_id) & (taken < self.max_id)] - self.min_id
+        # number of free ids below each taken id, non-decreasing
+        self._gaps = taken - np.arange(taken.shape[0], dtype='int64')
+        self.size = (self.max_id - self.min_id) - taken.shape[0]
+        self.counter = 0
+
+        self._half_bits = max(1, (int(self.size - 1).bit_length() + 1) // 2)
+        self._mask = np.uint64((1 << self._half_bits) - 1)
+        self._keys = np.random.SeedSequence(key).generate_state(FEISTEL_ROUNDS, dtype=np.uint64)
+
+    def take(self, n: int) -> np.ndarray:
+        '''
+        Allocates the next n ids
+        '''
+        ids = self.at(np.arange(self.counter, self.counter + n, dtype='int64'))
+        self.counter += n
+        return ids
+
+    def at(self, k: np.ndarray) -> np.ndarray:
+        '''
+        Returns the ids allocated at positions k, 0 <= k < size
+        '''
+        k = np.asarray(k, dtype='int64')
+        if k.size and (k.min() < 0 or k.max() >= self.size):
+            raise Exception(f'Unable to produce UID number {k.max()} with '
+                            f'{self.size} available UIDs')
+        p = self._permute(k.astype(np.uint64))
+        # cycle-walk values which land outside of [0, size)
+        out = p >= self.size
+        while out.any():
+            p[out] = self._permute(p[out])
+            out = p >= self.size
+        p = p.astype('int64')
+        return p + np.searchsorted(self._gaps, p, side='right') + self.min_id
+
+    def _permute(self, x: np.ndarray) -> np.ndarray:
+        h = np.uint64(self._half_bits)
+        left, right = x >> h, x & self._mask
+        for key in self._keys:
+            left, right = right, left ^ (_mix(right ^ key) & self._mask)
+        return (left << h) | right
+
+
+def _mix(x: np.ndarray) -> np.ndarray:
+    # splitmix64 finalizer
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xbf58476d1ce4e5b9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94d049bb133111eb)
+    return x ^ (x >> np.uint64(31))
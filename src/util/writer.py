@@ -0,0 +1,285 @@
+import os
+import json
+import shutil
+import logging
+import datetime
+import threading
+import numpy as np
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterator, List, NewType, Any
+from urllib.parse import quote
+
+DataFrame = NewType('DataFrame', pd.DataFrame)
+
+FORMATS = {'csv', 'parquet'}
+# partitioned tables list their partitions here; files starting
+# with an underscore are skipped by hive style readers
+MANIFEST = '_manifest.json'
+# directory name of a null partition value, as hive names it
+NULL_PARTITION = '__HIVE_DEFAULT_PARTITION__'
+# read_csv options reading back what to_csv wrote: nulls are empty
+# fields, and text such as the country code NA (Namibia) stays text
+CSV_NA = {'keep_default_na': False, 'na_values': ['']}
+
+
+def table_path(directory: str, name: str, fmt: str) -> str:
+    '''
+    Location of a table on disk; csv tables are a single file,
+    parquet tables a directory of part files
+    '''
+    return os.path.join(directory, f'{name}.{fmt}')
+
+
+class TableWriter:
+    '''
+    Keeps an output table open and appends DataFrame batches
+    to it as they arrive, so a table never has to be held in
+    memory in full. Extra keyword arguments are passed on to
+    DataFrame.to_csv for csv tables; parquet tables take
+    compression, row_group_size and index_label.
+    '''
+
+    def __init__(self, path: str, fmt: str = 'csv', mode: str = 'w', **kwargs):
+        if fmt not in FORMATS:
+            raise ValueError(f'Unknown output format {fmt!r}, expected one of {sorted(FORMATS)}')
+        self.path = path
+        self.fmt = fmt
+        self.rows = 0
+        self._kwargs = kwargs
+        self._header = mode == 'w' or not os.path.exists(path)
+        self._schema = None
+        if fmt == 'csv':
+            if mode == 'w' and os.path.isdir(path):
+                shutil.rmtree(path)
+            self._f = open(path, mode, newline='')
+        else:
+            import pyarrow.parquet as pq
+            if mode == 'w' and os.path.isdir(path):
+                shutil.rmtree(path)
+            os.makedirs(path, exist_ok=True)
+            self._part = os.path.join(path, f'part-{len(os.listdir(path)):05d}.parquet')
+            self._pq = pq
+            self._f = None
+            self._compression = kwargs.pop('compression', 'snappy')
+            self._row_group_size = kwargs.pop('row_group_size', None)
+            # batches are buffered up to row_group_size rows so that
+            # row groups do not follow the size of incoming batches
+            self._buffer = []
+            self._buffered = 0
+
+    def write(self, df: DataFrame):
+        if self.fmt == 'csv':
+            df.to_csv(self._f, header=self._header, **self._kwargs)
+            self._header = False
+        else:
+            import pyarrow as pa
+            if self._kwargs.get('index_label'):
+                df = df.rename_axis(self._kwargs['index_label'])
+            table = pa.Table.from_pandas(df, schema=self._schema, preserve_index=df.index.name is not None)
+            if self._f is None:
+                self._schema = table.schema
+                self._f = self._pq.ParquetWriter(self._part, self._schema, compression=self._compression)
+            self._buffer.append(table)
+            self._buffered += table.num_rows
+            if self._buffered >= (self._row_group_size or 0):
+                self._flush()
+        self.rows += df.shape[0]
+
+    def _flush(self):
+        import pyarrow as pa
+        if self._buffer:
+            self._f.write_table(pa.concat_tables(self._buffer), row_group_size=self._row_group_size)
+        self._buffer = []
+        self._buffered = 0
+
+    def close(self):
+        if self.fmt == 'parquet' and self._f is not None:
+            self._flush()
+        if self._f is not None:
+            self._f.close()
+        logging.debug(f'Wrote {self.rows} records to {self.path}')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def partition_path(partition_by: List[str], values: List[Any]) -> str:
+    '''
+    Directory of a partition relative to its table, hive style:
+    col=value for each partition column, with the characters
+    a path cannot hold escaped
+    '''
+    return os.path.join(*[f'{c}={NULL_PARTITION if pd.isna(v) else quote(str(v), safe=" ")}'
+                          for c, v in zip(partition_by, values)])
+
+
+def part_path(directory: str, fmt: str) -> str:
+    '''
+    Location of a partition's data; csv partitions are a single
+    file, parquet partitions a directory of part files
+    '''
+    return os.path.join(directory, 'part-00000.csv') if fmt == 'csv' else directory
+
+
+def stats(df: DataFrame) -> Dict[str, Dict[str, Any]]:
+    '''
+    Rows, and min and max of the numeric and datetime columns
+    and a named index, of a batch; values are as the manifest
+    holds them, which order the same, datetimes as iso strings
+    '''
+    if df.index.name is not None:
+        df = df.reset_index()
+    cols = df.select_dtypes(include=['number', 'datetime']).columns
+    return {'rows': df.shape[0],
+            'min': {c: jsonable(df[c].min()) for c in cols},
+            'max': {c: jsonable(df[c].max()) for c in cols}}
+
+
+def merge_stats(a: Dict[str, Any], b: Dict[str, Any]) -> Dict[str, Any]:
+    def pick(f, x, y):
+        # either side is null where a partition's column was all null
+        return y if x is None else x if y is None else f(x, y)
+    return {'rows': a['rows'] + b['rows'],
+            'min': {c: pick(min, a['min'].get(c), v) for c, v in b['min'].items()},
+            'max': {c: pick(max, a['max'].get(c), v) for c, v in b['max'].items()}}
+
+
+def jsonable(value: Any) -> Any:
+    # pd.NA, of nullable columns, is no numpy scalar
+    if pd.api.types.is_scalar(value) and pd.isna(value):
+        return None
+    if isinstance(value, (datetime.date, pd.Timestamp)):
+        return value.isoformat()
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+def write_manifest(path: str, fmt: str, partition_by: List[str], partitions: Dict[tuple, Dict[str, Any]]):
+    '''
+    Writes the manifest of a partitioned table: its partitions
+    by path, with their values, rows and column statistics
+    '''
+    listed = sorted(({'path': partition_path(partition_by, k),
+                      'values': dict(zip(partition_by, map(jsonable, k))),
+                      **v}
+                     for k, v in partitions.items()), key=lambda p: p['path'])
+    manifest = {'format': fmt,
+                'partition_by': partition_by,
+                'rows': sum(p['rows'] for p in listed),
+                'partitions': listed}
+    with open(os.path.join(path, MANIFEST), 'w') as f:
+        f.write(json.dumps(manifest, indent=2))
+
+
+def read_manifest(path: str) -> Dict[str, Any]:
+    '''
+    Manifest of a partitioned table, or None if the table at
+    path is not partitioned
+    '''
+    manifest = os.path.join(path, MANIFEST)
+    if not os.path.exists(manifest):
+        return None
+    with open(manifest) as f:
+        return json.loads(f.read())
+
+
+class PartitionedWriter:
+    '''
+    TableWriter of a table split into a directory per distinct
+    value of the partition_by columns, hive style, e.g.
+    orders.csv/order_year=2016/region=Africa/part-00000.csv.
+    Batches carry the partition columns, which are dropped as
+    their values are in the path; each batch is split across
+    its partitions and those are written in parallel across
+    workers threads. Rows and min/max statistics of each
+    partition are kept in the table's manifest, so readers can
+    skip partitions without opening them.
+    '''
+
+    def __init__(self, path: str, fmt: str = 'csv', partition_by: List[str] = None,
+                 mode: str = 'w', workers: int = None, **kwargs):
+        if fmt not in FORMATS:
+            raise ValueError(f'Unknown output format {fmt!r}, expected one of {sorted(FORMATS)}')
+        self.path = path
+        self.fmt = fmt
+        self.partition_by = partition_by
+        self.mode = mode
+        self.rows = 0
+        self._kwargs = kwargs
+        self._writers: Dict[tuple, TableWriter] = {}
+        self._stats: Dict[tuple, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        manifest = read_manifest(path) if mode == 'a' else None
+        if manifest is not None:
+            for p in manifest['partitions']:
+                key = tuple(p['values'][c] for c in partition_by)
+                self._stats[key] = {'rows': p['rows'], 'min': p['min'], 'max': p['max']}
+        elif os.path.isdir(path):
+            shutil.rmtree(path)
+        elif os.path.exists(path):
+            os.remove(path)
+        os.makedirs(path, exist_ok=True)
+
+    def write(self, df: DataFrame):
+        groups = df.groupby(self.partition_by, dropna=False, observed=True, sort=False)
+        writes = [self._executor.submit(self._write, tuple(map(jsonable, key)), part.drop(columns=self.partition_by))
+                  for key, part in groups]
+        for w in writes:
+            w.result()
+        self.rows += df.shape[0]
+
+    def _write(self, key: tuple, df: DataFrame):
+        with self._lock:
+            writer = self._writers.get(key)
+            if writer is None:
+                directory = os.path.join(self.path, partition_path(self.partition_by, key))
+                os.makedirs(directory, exist_ok=True)
+                writer = self._writers[key] = TableWriter(part_path(directory, self.fmt), self.fmt,
+                                                          self.mode, **self._kwargs)
+        # a partition is only ever written by one thread at a time
+        writer.write(df)
+        batch = stats(df)
+        self._stats[key] = merge_stats(self._stats[key], batch) if key in self._stats else batch
+
+    def close(self):
+        self._executor.shutdown()
+        for writer in self._writers.values():
+            writer.close()
+        write_manifest(self.path, self.fmt, self.partition_by, self._stats)
+        logging.debug(f'Wrote {self.rows} records to {len(self._writers)} partitions of {self.path}')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def read_table(path: str, fmt: str = 'csv', chunksize: int = 100000, columns: List[str] = None,
+               **kwargs) -> Iterator[DataFrame]:
+    '''
+    Reads a table written by TableWriter or PartitionedWriter
+    back in chunks, of only columns if given; partitioned
+    tables are read partition by partition, without their
+    partition columns
+    '''
+    manifest = read_manifest(path)
+    if manifest is not None:
+        for p in manifest['partitions']:
+            yield from read_table(part_path(os.path.join(path, p['path']), fmt), fmt, chunksize,
+                                  columns, **kwargs)
+        return
+    if fmt == 'csv':
+        yield from pd.read_csv(path, chunksize=chunksize, usecols=columns, **kwargs)
+        return
+    import pyarrow.parquet as pq
+    for part in sorted(os.listdir(path)):
+        for batch in pq.ParquetFile(os.path.join(path, part)).iter_batches(batch_size=chunksize,
+                                                                           columns=columns):
+            yield batch.to_pandas()
@@ -0,0 +1,160 @@
+import logging
+import numpy as np
+import pandas as pd
+from typing import Any, Dict, Iterable, NewType
+from util.helper import timer
+from util.sketch import Counts, Histogram
+
+DataFrame = NewType('DataFrame', pd.DataFrame)
+
+'''
+Fidelity of the bootstrapped rows to the source. The source and
+the generated rows are each summarized in one pass by fixed size
+sketches: counts of categorical columns, of ship and return delays
+in days and of returned rows, and histograms of numeric columns
+binned at the source's quantiles. Their divergence is reported as
+chi-square and total variation distance for counts and the KS
+statistic for histograms, flagged where past the configured limits.
+'''
+
+
+class Profile:
+    '''
+    Sketches of the validated columns of a stream of rows
+    '''
+
+    def __init__(self, conf: Dict[str, Any], edges: Dict[str, np.ndarray]):
+        self.rows = 0
+        self.counts = {c: Counts() for c in conf['categorical']}
+        self.histograms = {c: Histogram(e) for c, e in edges.items()}
+        self.ship_delay = Counts()
+        self.return_delay = Counts()
+        self.returned = Counts()
+
+    @classmethod
+    def of_source(cls, df: DataFrame, conf: Dict[str, Any]) -> 'Profile':
+        '''
+        Profile of the source rows; its histogram edges are
+        shared by the profiles it is compared with
+        '''
+        edges = {c: Histogram.from_quantiles(df[c], conf['bins']).edges for c in conf['numeric']}
+        profile = cls(conf, edges)
+        profile.update(df)
+        return profile
+
+    def empty(self, conf: Dict[str, Any]) -> 'Profile':
+        return Profile(conf, {c: h.edges for c, h in self.histograms.items()})
+
+    def update(self, df: DataFrame):
+        self.rows += df.shape[0]
+        for c, s in self.counts.items():
+            s.update(df[c])
+        for c, h in self.histograms.items():
+            h.update(df[c])
+        od = pd.to_datetime(df['order_date'])
+        self.ship_delay.update((pd.to_datetime(df['ship_date']) - od).dt.days)
+        self.return_delay.update((pd.to_datetime(df['return_date']) - od).dt.days)
+        self.returned.update(df['return_quantity'] > 0)
+
+    def merge(self, other: 'Profile'):
+        self.rows += other.rows
+        for c, s in self.counts.items():
+            s.merge(other.counts[c])
+        for c, h in self.histograms.items():
+            h.merge(other.histograms[c])
+        self.ship_delay.merge(other.ship_delay)
+        self.return_delay.merge(other.return_delay)
+        self.returned.merge(other.returned)
+
+    @property
+    def return_rate(self) -> float:
+        return self.returned.counts.get(True, 0) / max(self.returned.total, 1)
+
+
+@timer
+def validate(source: DataFrame, chunks: Iterable[DataFrame], conf: Dict[str, Any]) -> Dict[str, Any]:
+    '''
+    Compares the source rows with the generated rows streamed
+    in chunks; returns the fidelity report
+    '''
+    logging.info(f'Beginning validation...')
+    expected = Profile.of_source(source, conf)
+    generated = expected.empty(conf)
+    for df in chunks:
+        generated.update(df)
+    return report(expected, generated, conf)
+
+
+def report(source: Profile, generated: Profile, conf: Dict[str, Any]) -> Dict[str, Any]:
+    counts = {c: compare_counts(s, generated.counts[c], conf) for c, s in source.counts.items()}
+    counts['ship_delay_days'] = compare_counts(source.ship_delay, generated.ship_delay, conf)
+    counts['return_delay_days'] = compare_counts(source.return_delay, generated.return_delay, conf)
+    histograms = {c: compare_histograms(h, generated.histograms[c], conf)
+                  for c, h in source.histograms.items()}
+    difference = generated.return_rate - source.return_rate
+    returns = {
+        'source': source.return_rate,
+        'generated': generated.return_rate,
+        'difference': difference,
+        'diverged': bool(abs(difference) > conf['max_return_rate_difference'])
+    }
+    diverged = [c for c, r in {**counts, **histograms}.items() if r['diverged']]
+    if returns['diverged']:
+        diverged.append('return_rate')
+    for c in diverged:
+        logging.warning(f'Generated {c} diverges from the source')
+    return {
+        'source_rows': source.rows,
+        'generated_rows': generated.rows,
+        'diverged': diverged,
+        'counts': counts,
+        'histograms': histograms,
+        'return_rate': returns
+    }
+
+
+def compare_counts(source: Counts, generated: Counts, conf: Dict[str, Any]) -> Dict[str, Any]:
+    '''
+    Chi-square test of the two samples coming from the same
+    distribution, and the total variation distance of their
+    shares of each value
+    '''
+    from scipy.stats import chi2_contingency
+    keys = sorted(set(source.counts) | set(generated.counts))
+    table = np.array([source.frequencies(keys), generated.frequencies(keys)])
+    p = table / np.maximum(table.sum(axis=1, keepdims=True), 1)
+    tvd = float(np.abs(p[0] - p[1]).sum() / 2)
+    chi2 = p_value = None
+    if table.shape[1] > 1 and table.sum(axis=1).all():
+        chi2, p_value, _, _ = chi2_contingency(table)
+    return {
+        'chi2': chi2,
+        'p_value': p_value,
+        'tvd': tvd,
+        'diverged': tvd > conf['max_tvd'],
+        'source': dict(zip(map(str, keys), p[0].tolist())),
+        'generated': dict(zip(map(str, keys), p[1].tolist())),
+        'missing': {'source': source.missing, 'generated': generated.missing}
+    }
+
+
+def compare_histograms(source: Histogram, generated: Histogram, conf: Dict[str, Any]) -> Dict[str, Any]:
+    '''
+    Two-sample KS statistic taken at the bin edges, so it may
+    understate the exact one by up to a bin's share of the
+    rows, with its asymptotic p-value
+    '''
+    from scipy.stats import kstwobign
+    n, m = source.total, generated.total
+    ks = float(np.abs(source.cdf() - generated.cdf()).max()) if n and m else None
+    p_value = float(kstwobign.sf(ks * np.sqrt(n * m / (n + m)))) if ks is not None else None
+    return {
+        'ks': ks,
+        'p_value': p_value,
+        'diverged': ks is not None and ks > conf['max_ks'],
+        'quantiles': {str(q): {'source': source.quantile(q), 'generated': generated.quantile(q)}
+                      for q in conf['quantiles']},
+        'min': {'source': source.min, 'generated': generated.min},
+        'max': {'source': source.max, 'generated': generated.max},
+        'missing': {'source': source.missing, 'generated': generated.missing}
+    }